@@ -1,107 +1,414 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Optional, List, Tuple
+from typing import Any, Dict, Iterable, Optional, List, Tuple
+from collections import ChainMap, OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
+import asyncio
+import functools
+import hashlib
+import json
 import logging
-import secrets
-
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ASCENDING, DESCENDING, ReturnDocument
-from pymongo.errors import OperationFailure, DuplicateKeyError
+import os
+import time
+import zlib
+
+import bson
+from bson import Binary, ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import AsyncMongoClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, ExecutionTimeout, OperationFailure, WriteConcernError
+from pymongo.write_concern import WriteConcern
 
 from .settings import settings
 
 log = logging.getLogger("ktzh")
 
 
+# lockUntil "не залочено": дата в прошлом вместо None, чтобы claim был одним диапазоном
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
 def utcnow() -> datetime:
     return datetime.now(timezone.utc)
 
 
-def _keys_list(keys: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
-    return [(k, int(v)) for k, v in keys]
+def _hash_bin(h: Any) -> Any:
+    # sha256-hex (64 символа) -> 32 байта Binary: индекс по chatIdHash вдвое меньше
+    if not isinstance(h, str) or not h:
+        return h
+    try:
+        return Binary(bytes.fromhex(h))
+    except ValueError:
+        return h
+
+
+def _hash_q(h: str) -> Any:
+    # старые документы хранят hex-строку: ищем оба варианта,
+    # upsert-ы перезаписывают поле в Binary (ленивая миграция)
+    b = _hash_bin(h)
+    return {"$in": [b, h]} if b is not h else h
+
+
+_case_prefix: Tuple[int, str] = (0, "")
+
+
+def _fallback_case_id(now: datetime) -> str:
+    # префикс по секунде кэшируем: strftime только при смене секунды
+    global _case_prefix
+    sec = int(now.timestamp())
+    if _case_prefix[0] != sec:
+        _case_prefix = (sec, now.strftime("%Y%m%d%H%M%S"))
+    return f"KTZH-{_case_prefix[1]}-{os.urandom(3).hex().upper()}"
+
+
+def _message_doc(doc: Dict[str, Any], now: datetime) -> ChainMap:
+    if "_id" in doc:
+        # редкий случай: чужой _id выкидываем, тут без копии не обойтись
+        doc = {k: v for k, v in doc.items() if k != "_id"}
+
+    # _id генерим сами (ObjectId растёт со временем) — ответ сервера для него не нужен;
+    # в оверлей попадут _id и createdAt, doc вызывающего не трогаем
+    overlay: Dict[str, Any] = {"_id": ObjectId()}
+    if isinstance(doc.get("chatIdHash"), str):
+        overlay["chatIdHash"] = _hash_bin(doc["chatIdHash"])
+    if "createdAt" not in doc:
+        overlay["createdAt"] = now
+    return ChainMap(overlay, doc)
+
+
+@dataclass
+class WriteOp:
+    # одна операция в буфере записей
+    coll: Any  # AsyncCollection
+    model: Any  # InsertOne / UpdateOne
+    fut: Optional[asyncio.Future] = None  # ждёт ли кто-то результат
+
+
+# один клиент (пул соединений) на URI на процесс — все MongoStore делят его
+_CLIENTS: Dict[str, AsyncMongoClient] = {}
+_CLIENT_REFS: Dict[str, int] = {}
+
+
+def _client_kwargs() -> Dict[str, Any]:
+    w: Any = (settings.MONGO_W or "majority").strip()
+    # tz_aware: даты (createdAt/updatedAt/...) храним как BSON Date и читаем обратно aware-UTC
+    kw: Dict[str, Any] = dict(
+        tz_aware=True,
+        tzinfo=timezone.utc,
+        maxPoolSize=int(settings.MONGO_POOL or 50),
+        minPoolSize=int(settings.MONGO_MIN_POOL or 0),
+        maxConnecting=int(settings.MONGO_MAX_CONNECTING or 2),
+        retryWrites=True,
+        w=int(w) if w.isdigit() else w,
+        appname=settings.APP_NAME,
+        serverSelectionTimeoutMS=int(settings.MONGO_SERVER_SELECTION_MS or 3000),
+    )
+    # пустой MONGO_COMPRESSORS = без сжатия: ключ не передаём (None драйвер не принимает)
+    compressors = (settings.MONGO_COMPRESSORS or "").strip()
+    if compressors:
+        kw["compressors"] = compressors
+        kw["zlibCompressionLevel"] = 3
+    return kw
+
+
+_LAST_OPEN_CASE_PROJECTION: Dict[str, Any] = {
+    "caseId": 1,
+    "status": 1,
+    "type": 1,
+    "updatedAt": 1,
+}
+
+
+def _lock_seconds() -> int:
+    # ✅ фикс: поддерживаем оба названия env (чтобы не было "0" или None)
+    return int(
+        getattr(settings, "OPS_LOCK_SECONDS", None)
+        or getattr(settings, "OPS_WORKER_LOCK_SECONDS", None)
+        or 60
+    )
+
+
+def _hash_slot(case_id: str) -> int:
+    return zlib.crc32((case_id or "").encode("utf-8")) & 0xFFFF
+
+
+_CLAIM_INDEX = "outbox_pending_claim"
+
+
+def _outbox_key(kind: str, case_id: str, text: str, target: Dict[str, Any]) -> str:
+    # детерминированный ключ события: канонический JSON -> blake2b
+    raw = json.dumps([kind, case_id, text, target], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _claim_max_time_ms() -> int:
+    # потолок на claim-запрос: зависший план не должен стопорить воркер
+    return max(1, int(settings.OPS_CLAIM_MAX_TIME_MS or 500))
+
+
+# порядок claim совпадает с ESR-индексом outbox; списки неизменны — собираем один раз
+_CLAIM_SORT = [("nextAttemptAt", ASCENDING), ("createdAt", ASCENDING)]
+_LAST_OPEN_CASE_SORT = [("updatedAt", DESCENDING), ("createdAt", DESCENDING)]
+
+
+@functools.lru_cache(maxsize=1)
+def _claim_static() -> Tuple[Tuple[str, Any], ...]:
+    # части фильтра claim, зависящие только от settings (frozen) — считаем один раз
+    max_attempts = int(getattr(settings, "OPS_MAX_ATTEMPTS", 10) or 10)
+    parts: List[Tuple[str, Any]] = [("attempts", {"$lt": max_attempts})]
+    # несколько воркеров: каждый берёт только свой срез по hashSlot, друг другу не мешают
+    count = int(settings.OPS_WORKER_COUNT or 1)
+    if count > 1:
+        parts.append(("hashSlot", {"$mod": [count, int(settings.OPS_WORKER_ID or 0) % count]}))
+    return tuple(parts)
+
+
+def _claim_filter(now: datetime) -> Dict[str, Any]:
+    # новый dict на каждый вызов: фильтр уходит в драйвер, общий шаблон не мутируем
+    q: Dict[str, Any] = {
+        "status": "pending",
+        "nextAttemptAt": {"$lte": now},
+        "lockUntil": {"$lte": now},
+    }
+    q.update(_claim_static())
+    return q
 
 
 class MongoStore:
     def __init__(self) -> None:
-        self.client: Optional[AsyncIOMotorClient] = None
+        self.client: Optional[AsyncMongoClient] = None
+        self._uri: str = ""
         self.db = None
         self.sessions = None
+        self.sessions_raw = None
         self.messages = None
         self.cases = None
+        self.case_followups = None
         self.ops_outbox = None
         self.enabled: bool = False
 
-    async def _ensure_index(self, coll, keys: List[Tuple[str, int]], **opts) -> None:
-        keys_norm = _keys_list(keys)
-
-        # 1) если индекс уже есть по key-pattern — ничего не делаем
-        try:
-            async for idx in coll.list_indexes():
-                existing = list(idx.get("key", {}).items())
-                existing = _keys_list(existing)
-                if existing == keys_norm:
-                    if opts.get("unique") and not idx.get("unique", False):
-                        log.warning("Mongo index exists but NOT unique for %s on %s", keys_norm, coll.name)
-                    return
-        except Exception as e:
-            log.warning("Mongo list_indexes failed for %s: %s", getattr(coll, "name", "unknown"), e)
+        # буфер записей WriteOp (messages/sessions/cases — одна очередь);
+        # _flush_loop группирует по коллекциям и пишет через bulk_write
+        self._write_buf: Optional[asyncio.Queue] = None
+        self._flush_task: Optional[asyncio.Task] = None
+
+        # chatIdHash -> (monotonic ts, сессия в виде BSON-байт)
+        self._sess_cache: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._sess_codec: CodecOptions = CodecOptions(tz_aware=True, tzinfo=timezone.utc)
+        # SESSION_WRITE_BEHIND: на чат не больше одной записи в полёте;
+        # пока она пишется, копится только последняя версия сессии
+        self._sess_inflight: Dict[str, asyncio.Future] = {}
+        self._sess_next: Dict[str, ReplaceOne] = {}
+        # фоновые put в переполненный буфер (write-behind не ждёт места сам)
+        self._put_tasks: "set[asyncio.Task]" = set()
+
+        # claim outbox идёт с hint на partial-индекс, пока сервер его принимает
+        self._claim_hint: bool = True
+
+    async def _ensure_indexes(self, coll, models: List[IndexModel], legacy: frozenset = frozenset()) -> None:
+        # 1) обычный старт: createIndexes идемпотентен при тех же опциях —
+        #    шлём все индексы одной командой, без предварительного listIndexes
+        if not settings.RUN_MIGRATIONS:
+            missing = list(models)
+        else:
+            missing = await self._probe_indexes(coll, models, legacy)
+
+        if not missing:
+            return
 
-        # 2) создаём, но не падаем на конфликтах/дублях
+        # 2) все (недостающие) — одной командой createIndexes
         try:
-            await coll.create_index(keys, **opts)
-        except DuplicateKeyError as e:
-            log.warning("Mongo index create skipped (duplicate key) for %s on %s: %s", keys_norm, coll.name, e)
+            await coll.create_indexes(missing)
             return
-        except OperationFailure as e:
-            code = getattr(e, "code", None)
-            # 85 = IndexOptionsConflict, 11000 = duplicate key
-            if code in (85, 11000):
-                log.warning("Mongo index create skipped (code %s) for %s on %s: %s", code, keys_norm, coll.name, e)
+        except (DuplicateKeyError, OperationFailure) as e:
+            if getattr(e, "code", None) not in (85, 86, 11000):
+                raise
+            if len(missing) == 1:
+                log.warning("Mongo index create skipped (code %s) on %s: %s", e.code, coll.name, e)
                 return
-            raise
-
-    async def connect(self) -> None:
+            log.warning("Mongo createIndexes failed (code %s) on %s, retrying one by one", e.code, coll.name)
+
+        # 3) команда атомарна: при конфликте одного индекса создаём остальные по одному
+        for model in missing:
+            keys_norm = tuple(model.document["key"].items())
+            try:
+                await coll.create_indexes([model])
+            except DuplicateKeyError as e:
+                log.warning("Mongo index create skipped (duplicate key) for %s on %s: %s", keys_norm, coll.name, e)
+            except OperationFailure as e:
+                code = getattr(e, "code", None)
+                # 85 = IndexOptionsConflict, 86 = IndexKeySpecsConflict, 11000 = duplicate key
+                if code in (85, 86, 11000):
+                    log.warning("Mongo index create skipped (code %s) for %s on %s: %s", code, keys_norm, coll.name, e)
+                    continue
+                raise
+
+    async def _probe_indexes(self, coll, models: List[IndexModel], legacy: frozenset) -> List[IndexModel]:
+        """
+        RUN_MIGRATIONS: смотрим, что уже есть, сносим legacy и
+        возвращаем только недостающие индексы.
+        """
+        # index_information — одна команда listIndexes, сразу dict name -> spec
+        try:
+            info = await coll.index_information()
+        except Exception as e:
+            log.warning("Mongo index_information failed for %s: %s", getattr(coll, "name", "unknown"), e)
+            info = {}
+
+        # сносим устаревшие индексы
+        to_drop = legacy & info.keys()
+        if to_drop:
+            await asyncio.gather(*(coll.drop_index(name) for name in to_drop))
+            log.info("Mongo legacy indexes dropped on %s: %s", coll.name, sorted(to_drop))
+            # повторный index_information не нужен — убираем снесённые локально
+            info = {name: spec for name, spec in info.items() if name not in to_drop}
+
+        # уже существующие key-pattern пропускаем (dict: поиск O(1));
+        # index_information отдаёт key списком пар — tuple сразу hashable,
+        # а 1.0 == 1 и hash у них общий, так что int() не нужен
+        # (и не падает на "text"/"2dsphere")
+        existing = {tuple(spec["key"]): spec for spec in info.values()}
+
+        missing: List[IndexModel] = []
+        for model in models:
+            spec = model.document
+            keys_norm = tuple(spec["key"].items())
+            found = existing.get(keys_norm)
+            if found is None:
+                missing.append(model)
+            elif spec.get("unique") and not found.get("unique", False):
+                log.warning("Mongo index exists but NOT unique for %s on %s", keys_norm, coll.name)
+        return missing
+
+    async def connect(self, *, migrate_outbox: bool = False) -> None:
         uri = (settings.MONGODB_URI or "").strip()
         if not uri:
             self.enabled = False
             return
 
-        self.client = AsyncIOMotorClient(uri)
+        if uri not in _CLIENTS:
+            _CLIENTS[uri] = AsyncMongoClient(uri, **_client_kwargs())
+        _CLIENT_REFS[uri] = _CLIENT_REFS.get(uri, 0) + 1
+        self._uri = uri
+        self.client = _CLIENTS[uri]
         self.db = self.client[settings.DB_NAME]
 
         self.sessions = self.db[settings.COL_SESSIONS]
+        # чтения сессий — без разбора в dict: байты идут прямо в кэш
+        self._sess_codec = self.sessions.codec_options
+        self.sessions_raw = self.sessions.with_options(
+            codec_options=self._sess_codec.with_options(document_class=RawBSONDocument)
+        )
         self.messages = self.db[settings.COL_MESSAGES]
-        self.cases = self.db[settings.COL_CASES]
+        # лог переписки пишется буфером: ack репликации и журнала не ждём
+        msg_w = max(0, int(settings.MESSAGES_W))
+        self.messages = self.messages.with_options(
+            write_concern=WriteConcern(w=msg_w, j=False) if msg_w else WriteConcern(w=0)
+        )
+        # кейсы и outbox терять нельзя: w клиента (MONGO_W) + обязательный журнал;
+        # w=0 с j=True драйвер не принимает (ConfigurationError) — тогда "majority"
+        durable_w = self.client.write_concern.document.get("w", "majority")
+        durable = WriteConcern(w=durable_w if durable_w != 0 else "majority", j=True)
+        self.cases = self.db.get_collection(settings.COL_CASES, write_concern=durable)
+        self.case_followups = self.db.get_collection(settings.COL_CASE_FOLLOWUPS, write_concern=durable)
 
         # optional outbox
         col_outbox = getattr(settings, "COL_OPS_OUTBOX", None)
         if col_outbox:
-            self.ops_outbox = self.db[col_outbox]
+            self.ops_outbox = self.db.get_collection(col_outbox, write_concern=durable)
 
         await self.db.command("ping")
 
-        # ---- индексы sessions/messages/cases ----
-        await self._ensure_index(self.sessions, [("chatIdHash", ASCENDING)], unique=True)
-        await self._ensure_index(self.messages, [("chatIdHash", ASCENDING), ("createdAt", ASCENDING)])
-        await self._ensure_index(self.cases, [("chatIdHash", ASCENDING), ("status", ASCENDING), ("type", ASCENDING)])
-        await self._ensure_index(
-            self.cases,
-            [("chatIdHash", ASCENDING), ("status", ASCENDING), ("updatedAt", DESCENDING)],
-        )
-        await self._ensure_index(self.cases, [("caseId", ASCENDING)], unique=True)
+        # прогрев пула: параллельные ping открывают minPoolSize сокетов
+        # (TLS-рукопожатия) до первого всплеска вебхуков
+        warm = int(settings.MONGO_MIN_POOL or 0) - 1
+        if warm > 0:
+            await asyncio.gather(*(self.db.command("ping") for _ in range(warm)))
+
+        # ---- индексы: по одному createIndexes на коллекцию, коллекции параллельно ----
+        # (coll, нужные индексы, frozenset имён устаревших индексов для RUN_MIGRATIONS)
+        indexes = [
+            (self.sessions, [IndexModel([("chatIdHash", ASCENDING)], unique=True)], frozenset()),
+            # индексы — через коллекцию с обычным write concern (у self.messages может быть w=0)
+            (self.db[settings.COL_MESSAGES], [IndexModel([("chatIdHash", ASCENDING), ("createdAt", ASCENDING)])], frozenset()),
+            (self.cases, [
+                # get_last_open_case: только открытые кейсы (partial) + сортировка без SORT-стадии
+                IndexModel(
+                    [("chatIdHash", ASCENDING), ("updatedAt", DESCENDING), ("createdAt", DESCENDING)],
+                    partialFilterExpression={"status": "open"},
+                    name="case_open_chatIdHash_updatedAt",
+                ),
+                IndexModel([("caseId", ASCENDING)], unique=True),
+            ], frozenset({"chatIdHash_1_status_1_type_1", "chatIdHash_1_status_1_updatedAt_-1"})),
+            (self.case_followups, [
+                IndexModel([("caseId", ASCENDING), ("bucket", DESCENDING)], unique=True),
+            ], frozenset()),
+        ]
 
         # ---- индексы outbox (если включён) ----
         if self.ops_outbox is not None:
-            await self._ensure_index(self.ops_outbox, [("status", ASCENDING), ("nextAttemptAt", ASCENDING)])
-            await self._ensure_index(self.ops_outbox, [("lockUntil", ASCENDING)])
-            await self._ensure_index(self.ops_outbox, [("kind", ASCENDING), ("caseId", ASCENDING)], unique=True)
+            indexes.append((self.ops_outbox, [
+                # claim: только pending (partial, sent/failed в индекс не попадают);
+                # ESR: сортировка (nextAttemptAt, createdAt), затем диапазон lockUntil
+                IndexModel(
+                    [("nextAttemptAt", ASCENDING), ("createdAt", ASCENDING), ("lockUntil", ASCENDING)],
+                    partialFilterExpression={"status": "pending"},
+                    name=_CLAIM_INDEX,
+                ),
+                IndexModel([("kind", ASCENDING), ("caseId", ASCENDING)], unique=True),
+                # TTL: отправленные записи сервер удаляет сам, failed остаются для разбора
+                IndexModel(
+                    [("sentAt", ASCENDING)],
+                    expireAfterSeconds=int(settings.OPS_OUTBOX_SENT_TTL_SECONDS or 86400),
+                    partialFilterExpression={"status": "sent"},
+                    name="outbox_sent_ttl",
+                ),
+            ], frozenset({
+                "status_1_nextAttemptAt_1",
+                "lockUntil_1",
+                "status_1_nextAttemptAt_1_createdAt_1",
+                "status_1_nextAttemptAt_1_createdAt_1_lockUntil_1",
+            })))
+
+        await asyncio.gather(*(self._ensure_indexes(coll, models, legacy) for coll, models, legacy in indexes))
+
+        # backfill outbox нужен claim'у (иначе legacy-записи не забираются): его гоняет
+        # ops-воркер на старте (migrate_outbox=True), web — только с RUN_MIGRATIONS
+        if (migrate_outbox or settings.RUN_MIGRATIONS) and self.ops_outbox is not None:
+            await self._migrate_outbox()
+
+        self._write_buf = asyncio.Queue(maxsize=max(1, int(settings.WRITE_QUEUE_MAX or 10000)))
+        self._flush_task = asyncio.create_task(self._flush_loop())
 
         self.enabled = True
 
     async def close(self) -> None:
+        # отложенные записи сессий (write-behind) дописываем до остановки буфера
+        while self._sess_inflight:
+            await asyncio.gather(*list(self._sess_inflight.values()), return_exceptions=True)
+
+        if self._flush_task is not None:
+            # None = сигнал "допиши что осталось и выходи"
+            await self._write_buf.put(None)
+            try:
+                await self._flush_task
+            except Exception:
+                log.warning("Mongo write flush task failed on close", exc_info=True)
+            self._flush_task = None
+            self._write_buf = None
+
         if self.client is not None:
-            self.client.close()
+            # общий клиент закрываем только вместе с последним MongoStore
+            left = _CLIENT_REFS.get(self._uri, 1) - 1
+            if left <= 0:
+                _CLIENT_REFS.pop(self._uri, None)
+                _CLIENTS.pop(self._uri, None)
+                await self.client.close()
+            else:
+                _CLIENT_REFS[self._uri] = left
             self.client = None
         self.enabled = False
 
@@ -109,47 +416,249 @@ class MongoStore:
     async def get_session(self, chat_id_hash: str) -> Optional[Dict[str, Any]]:
         if not self.enabled:
             return None
-        return await self.sessions.find_one({"chatIdHash": chat_id_hash})
 
-    async def save_session(self, chat_id_hash: str, session: Dict[str, Any]) -> None:
+        hit = self._sess_cache.get(chat_id_hash)
+        if hit is not None:
+            ts, data = hit
+            # пока запись write-behind не дошла, в базе старая версия — отдаём кэш и после TTL
+            if time.monotonic() - ts <= settings.SESSION_CACHE_TTL_MS / 1000.0 or chat_id_hash in self._sess_inflight:
+                self._sess_cache.move_to_end(chat_id_hash)
+                # decode каждый раз даёт свежий dict (dialog мутирует сессию на месте)
+                return bson.decode(data, codec_options=self._sess_codec)
+            self._sess_cache.pop(chat_id_hash, None)
+
+        raw = await self.sessions_raw.find_one({"chatIdHash": _hash_q(chat_id_hash)})
+        if raw is None:
+            return None
+        self._cache_session(chat_id_hash, raw.raw)
+        return bson.decode(raw.raw, codec_options=self._sess_codec)
+
+    def _cache_session(self, chat_id_hash: str, data: bytes) -> None:
+        cache = self._sess_cache
+        cache[chat_id_hash] = (time.monotonic(), data)
+        cache.move_to_end(chat_id_hash)
+        while len(cache) > max(1, int(settings.SESSION_CACHE_MAX or 10000)):
+            # сессии с незаписанной write-behind версией не вытесняем (см. get_session)
+            victim = next((k for k in cache if k not in self._sess_inflight), None)
+            if victim is None:
+                break
+            del cache[victim]
+
+    async def save_session(self, chat_id_hash: str, session: Dict[str, Any], *, now: Optional[datetime] = None) -> None:
         if not self.enabled:
             return
 
-        doc = dict(session)
-        created = doc.get("createdAt") or utcnow().isoformat()
-
+        now = now or utcnow()
+        created = session.get("createdAt") or now
+        # старые сессии держат createdAt ISO-строкой — в базу и кэш кладём Date
+        if isinstance(created, str):
+            try:
+                created = datetime.fromisoformat(created)
+            except ValueError:
+                created = now
+
+        # _id и createdAt не должны быть в $set — отфильтровываем за один проход
+        doc = {k: v for k, v in session.items() if k not in ("_id", "createdAt")}
         doc["chatIdHash"] = chat_id_hash
-        doc["updatedAt"] = utcnow().isoformat()
-
-        # createdAt не должен быть в $set
-        doc.pop("_id", None)
-        doc.pop("createdAt", None)
+        doc["updatedAt"] = now
 
-        await self.sessions.update_one(
-            {"chatIdHash": chat_id_hash},
-            {"$set": doc, "$setOnInsert": {"createdAt": created}},
-            upsert=True,
+        behind = settings.SESSION_WRITE_BEHIND and (
+            len(self._sess_inflight) + len(self._sess_next) < max(1, int(settings.SESSION_WRITE_BEHIND_MAX or 1000))
         )
+        if behind:
+            # ход диалога не ждёт Mongo: полный replace (промежуточные версии можно
+            # выбросить), кодируем сразу — вызывающий волен дальше менять session
+            full = RawBSONDocument(bson.encode({**doc, "chatIdHash": _hash_bin(chat_id_hash), "createdAt": created}))
+            self._write_behind(chat_id_hash, ReplaceOne({"chatIdHash": _hash_q(chat_id_hash)}, full, upsert=True))
+        else:
+            # буфер write-behind переполнен (Mongo не успевает): пишем синхронно, но сначала
+            # дожидаемся отложенной записи этого чата, чтобы не обогнать её в bulk_write
+            while chat_id_hash in self._sess_inflight:
+                await asyncio.gather(self._sess_inflight[chat_id_hash], return_exceptions=True)
+
+            # полный $set: diff против кэша этого процесса при нескольких воркерах
+            # смешал бы в базе две версии сессии — так пишется хотя бы одна целиком
+            update: Dict[str, Any] = {
+                "$set": ChainMap({"chatIdHash": _hash_bin(chat_id_hash)}, doc),
+                "$setOnInsert": {"createdAt": created},
+            }
+
+            op = UpdateOne({"chatIdHash": _hash_q(chat_id_hash)}, update, upsert=True)
+            try:
+                await self._queue_write(self.sessions, op, wait=True)
+            except Exception:
+                self._sess_cache.pop(chat_id_hash, None)
+                raise
+
+        doc["createdAt"] = created
+        self._cache_session(chat_id_hash, bson.encode(doc))
+
+    def _write_behind(self, chat_id_hash: str, model: ReplaceOne) -> None:
+        if chat_id_hash in self._sess_inflight:
+            # предыдущая версия ещё пишется — эту отправим следом (порядок по чату сохраняется)
+            self._sess_next[chat_id_hash] = model
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._sess_inflight[chat_id_hash] = fut
+        fut.add_done_callback(functools.partial(self._write_behind_done, chat_id_hash))
+        op = WriteOp(self.sessions, model, fut)
+        try:
+            self._write_buf.put_nowait(op)
+        except asyncio.QueueFull:
+            # буфер полон: ждём места в фоне, запись остаётся in-flight (close её дождётся)
+            task = asyncio.get_running_loop().create_task(self._write_buf.put(op))
+            self._put_tasks.add(task)
+            task.add_done_callback(self._put_tasks.discard)
+
+    def _write_behind_done(self, chat_id_hash: str, fut: asyncio.Future) -> None:
+        self._sess_inflight.pop(chat_id_hash, None)
+        err = None if fut.cancelled() else fut.exception()
+        nxt = self._sess_next.pop(chat_id_hash, None)
+        if nxt is not None and self._write_buf is not None:
+            # следующая версия — полный replace, она же исправит неудачную запись
+            self._write_behind(chat_id_hash, nxt)
+        elif err is not None:
+            log.warning("Mongo session write-behind failed for %s: %s", chat_id_hash[:8], err)
+            self._sess_cache.pop(chat_id_hash, None)
 
     # ---------- messages ----------
-    async def add_message(self, doc: Dict[str, Any]) -> None:
+    async def add_message(self, doc: Dict[str, Any], *, now: Optional[datetime] = None) -> None:
+        """
+        Не ждёт записи: документ уходит в общий буфер и вставится пачкой
+        (при переполненном буфере, MONGO_WRITE_QUEUE_MAX, — отбрасывается).
+        doc не копируется (пишем через ChainMap-оверлей), поэтому после
+        вызова его нельзя менять.
+        """
         if not self.enabled:
             return
-        d = dict(doc)
-        d.pop("_id", None)
-        d.setdefault("createdAt", utcnow().isoformat())
-        await self.messages.insert_one(d)
+        await self._queue_write(self.messages, InsertOne(_message_doc(doc, now or utcnow())))
+
+    async def add_messages(self, docs: List[Dict[str, Any]], *, now: Optional[datetime] = None) -> None:
+        """
+        Все сообщения одного webhook-а разом: попадают в буфер подряд
+        и уходят одним bulk_write. Те же правила, что у add_message.
+        """
+        if not self.enabled or not docs:
+            return
+        now = now or utcnow()
+        for doc in docs:
+            await self._queue_write(self.messages, InsertOne(_message_doc(doc, now)))
+
+    # ---------- batched writes ----------
+    async def _queue_write(self, coll, op, wait: bool = False) -> None:
+        """
+        Кладёт операцию в буфер. wait=True — дождаться, пока пачка с ней
+        будет записана (ошибка этой операции пробрасывается вызывающему).
+        """
+        if not wait and self._write_buf.full():
+            # Mongo не успевает (или недоступен): то, что никто не ждёт (лог сообщений),
+            # не копим без предела — отбрасываем; ждущие записи ждут места в буфере
+            log.warning("Mongo write buffer full, dropping %s write to %s", type(op).__name__, coll.name)
+            return
+        fut = asyncio.get_running_loop().create_future() if wait else None
+        await self._write_buf.put(WriteOp(coll, op, fut))
+        if fut is not None:
+            await fut
+
+    async def _flush_loop(self) -> None:
+        """
+        Ждём первую операцию, потом добираем ещё до WRITE_BATCH штук
+        (но не дольше WRITE_FLUSH_MS) и пишем.
+        Если в пачке есть операция, которую ждут, — не держим её по таймеру,
+        добираем только то, что уже лежит в очереди.
+        """
+        batch_max = max(1, int(settings.WRITE_BATCH or 200))
+        flush_sec = max(1, int(settings.WRITE_FLUSH_MS or 100)) / 1000.0
+        loop = asyncio.get_running_loop()
+
+        while True:
+            first = await self._write_buf.get()
+            if first is None:
+                return
+
+            batch: List[WriteOp] = [first]
+            waited = first.fut is not None
+            stop = False
+            deadline = loop.time() + flush_sec
+
+            while len(batch) < batch_max:
+                try:
+                    if waited:
+                        item = self._write_buf.get_nowait()
+                    else:
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        item = await asyncio.wait_for(self._write_buf.get(), timeout=timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+                waited = waited or item.fut is not None
+
+            await self._flush(batch)
+            if stop:
+                return
+
+    async def _flush(self, batch: List[WriteOp]) -> None:
+        # раскладываем по коллекциям, на каждую — один bulk_write, все параллельно
+        pending: Dict[str, List[WriteOp]] = {}
+        for w in batch:
+            pending.setdefault(w.coll.name, []).append(w)
+
+        await asyncio.gather(*(self._bulk_write(items[0].coll, items) for items in pending.values()))
+
+    async def _bulk_write(self, coll, items: List[WriteOp]) -> None:
+        errors: Dict[int, Exception] = {}
+        try:
+            await coll.bulk_write([w.model for w in items], ordered=False)
+        except BulkWriteError as e:
+            for we in e.details.get("writeErrors", []):
+                code = we.get("code")
+                exc_cls = DuplicateKeyError if code == 11000 else OperationFailure
+                errors[we.get("index")] = exc_cls(we.get("errmsg", ""), code, we)
+            # write concern (w / j) не подтверждён — ни одной записи пачки нельзя считать надёжной
+            wce = e.details.get("writeConcernErrors") or []
+            if wce:
+                err = WriteConcernError(wce[-1].get("errmsg", ""), wce[-1].get("code"), wce[-1])
+                errors = {i: errors.get(i, err) for i in range(len(items))}
+            log.warning("Mongo bulk_write %s: %s of %s op(s) failed", coll.name, len(errors), len(items))
+        except Exception as e:
+            log.warning("Mongo bulk_write %s failed for %s op(s): %s", coll.name, len(items), e)
+            errors = {i: e for i in range(len(items))}
+
+        for i, w in enumerate(items):
+            fut = w.fut
+            if fut is None or fut.done():
+                continue
+            if i in errors:
+                fut.set_exception(errors[i])
+            else:
+                fut.set_result(None)
 
     # ---------- cases ----------
-    async def create_case(self, doc: Dict[str, Any]) -> None:
+    async def create_case(
+        self,
+        doc: Dict[str, Any],
+        copy: bool = True,
+        *,
+        now: Optional[datetime] = None,
+    ) -> Optional[Dict[str, Any]]:
         """
         Идемпотентное создание кейса.
         updatedAt обновляем ТОЛЬКО через $set.
+        Возвращает {"caseId": ...} записанного кейса — перечитывать его
+        не нужно (upsert по caseId, так что id известен заранее).
+        copy=False — doc свой у вызывающего, правим его на месте без копии.
         """
         if not self.enabled:
-            return
+            return None
+
+        now = now or utcnow()
 
-        d = dict(doc)
+        d = dict(doc) if copy else doc
         d.pop("_id", None)
 
         # гарантируем caseId
@@ -157,7 +666,7 @@ class MongoStore:
             if d.get("ticketId"):
                 d["caseId"] = str(d["ticketId"])
             else:
-                d["caseId"] = f"KTZH-{utcnow().strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(3).upper()}"
+                d["caseId"] = _fallback_case_id(now)
 
         # гарантируем payload.followups
         payload = d.get("payload") or {}
@@ -166,26 +675,36 @@ class MongoStore:
         payload.setdefault("followups", [])
         d["payload"] = payload
 
-        now = utcnow().isoformat()
         created = d.get("createdAt") or now
+        if isinstance(created, str):
+            # dialog отдаёт ISO-строку — в базу кладём BSON Date
+            try:
+                created = datetime.fromisoformat(created)
+            except ValueError:
+                created = now
 
         d.pop("createdAt", None)
         d.pop("updatedAt", None)
 
-        insert_doc = dict(d)
-        insert_doc["createdAt"] = created
+        # _id генерим на клиенте: в логах сразу виден id записанного кейса
+        insert_doc = ChainMap({"_id": ObjectId(), "createdAt": created}, d)
+        if isinstance(d.get("chatIdHash"), str):
+            insert_doc.maps[0]["chatIdHash"] = _hash_bin(d["chatIdHash"])
 
+        op = UpdateOne(
+            {"caseId": d["caseId"]},
+            {
+                "$setOnInsert": insert_doc,
+                "$set": {"updatedAt": now},
+            },
+            upsert=True,
+        )
         try:
-            await self.cases.update_one(
-                {"caseId": d["caseId"]},
-                {
-                    "$setOnInsert": insert_doc,
-                    "$set": {"updatedAt": now},
-                },
-                upsert=True,
-            )
+            await self._queue_write(self.cases, op, wait=True)
         except DuplicateKeyError as e:
             log.warning("create_case: duplicate key for caseId=%s: %s", d.get("caseId"), e)
+            return None
+        return {"caseId": d["caseId"]}
 
     async def get_case(self, case_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -209,7 +728,7 @@ class MongoStore:
         - closedAt/updatedAt
         - closeReason=ops_resolved
         - resolutionText
-        - + followup note в payload.followups
+        - + followup note (в case_followups)
         Возвращает обновлённый документ кейса (или None если не найден).
         """
         if not self.enabled:
@@ -217,7 +736,7 @@ class MongoStore:
         if not case_id:
             return None
 
-        now = utcnow().isoformat()
+        now = utcnow()
         note = {
             "ts": now,
             "text": (resolution_text or "").strip(),
@@ -235,40 +754,138 @@ class MongoStore:
                     "closeReason": "ops_resolved",
                     "resolutionText": (resolution_text or "").strip(),
                 },
-                "$push": {"payload.followups": note},
+                "$inc": {"followupCount": 1},
             },
             return_document=ReturnDocument.AFTER,
         )
+        if doc is not None:
+            try:
+                await self._push_followup(case_id, doc.get("followupCount", 1), note, now)
+            except Exception as e:
+                # кейс уже закрыт — потеряна только заметка, закрытие вызывающему не ошибка
+                log.warning("close_case: followup note #%s not stored for %s: %s", doc.get("followupCount"), case_id, e)
         return doc
 
-    async def get_last_open_case(self, chat_id_hash: str) -> Optional[Dict[str, Any]]:
+    async def get_last_open_case(
+        self,
+        chat_id_hash: str,
+        projection: Optional[Dict[str, Any]] = None,
+        fields: Optional[Iterable[str]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        По умолчанию без payload: dialog-у нужен только caseId.
+        fields — короткая запись projection: ["caseId", "payload.shared"].
+        """
         if not self.enabled:
             return None
+        if projection is None and fields is not None:
+            projection = {f: 1 for f in fields}
 
         return await self.cases.find_one(
-            {"chatIdHash": chat_id_hash, "status": "open"},
-            sort=[("updatedAt", DESCENDING), ("createdAt", DESCENDING)],
+            {"chatIdHash": _hash_q(chat_id_hash), "status": "open"},
+            projection or _LAST_OPEN_CASE_PROJECTION,
+            sort=_LAST_OPEN_CASE_SORT,
         )
 
-    async def append_case_followup(self, case_id: str, note: Dict[str, Any]) -> bool:
+    async def append_case_followup(self, case_id: str, note: Dict[str, Any], copy: bool = True) -> bool:
         if not self.enabled:
             return False
 
-        n = dict(note or {})
-        n.setdefault("ts", utcnow().isoformat())
+        now = utcnow()
+        n = dict(note or {}) if copy or not note else note
+        n.setdefault("ts", now)
         n.setdefault("text", "")
 
-        res = await self.cases.update_one(
+        # счётчик заметок на кейсе даёт номер пачки; сам кейс не растёт
+        doc = await self.cases.find_one_and_update(
             {"caseId": case_id, "status": "open"},
-            {"$push": {"payload.followups": n}, "$set": {"updatedAt": utcnow().isoformat()}},
+            {"$inc": {"followupCount": 1}, "$set": {"updatedAt": now}},
+            projection={"followupCount": 1},
+            return_document=ReturnDocument.AFTER,
         )
 
-        if res.matched_count == 0:
+        if doc is None:
             log.warning("append_case_followup: open case not found: %s", case_id)
             return False
+        try:
+            await self._push_followup(case_id, doc.get("followupCount", 1), n, now)
+        except Exception as e:
+            # followupCount уже увеличен: номер остаётся без заметки, пачки это переживают
+            log.warning("append_case_followup: note #%s not stored for %s: %s", doc.get("followupCount"), case_id, e)
+            return False
         return True
 
+    async def _push_followup(self, case_id: str, count: int, note: Dict[str, Any], now: datetime) -> None:
+        """
+        Заметка count (с 1) кладётся в пачку (count-1) // FOLLOWUP_BUCKET
+        коллекции case_followups: {caseId, bucket, notes: [...]}.
+        """
+        bucket = (max(1, int(count)) - 1) // max(1, int(settings.FOLLOWUP_BUCKET or 100))
+        op = UpdateOne(
+            {"caseId": case_id, "bucket": bucket},
+            {"$push": {"notes": note}, "$setOnInsert": {"createdAt": now}},
+            upsert=True,
+        )
+        try:
+            await self._queue_write(self.case_followups, op, wait=True)
+        except DuplicateKeyError:
+            # два upsert-а одной новой пачки разом: второй упёрся в unique (caseId, bucket),
+            # но пачка уже есть — повтор просто сделает $push
+            await self._queue_write(self.case_followups, op, wait=True)
+
+    async def get_case_followups(self, case_id: str, limit_buckets: int = 1) -> List[Dict[str, Any]]:
+        """
+        Последние заметки кейса: новые пачки первыми, внутри пачки — по порядку.
+        Старые кейсы держат заметки ещё и в payload.followups.
+        """
+        if not self.enabled or not case_id:
+            return []
+        cur = self.case_followups.find(
+            {"caseId": case_id},
+            {"notes": 1, "_id": 0},
+            sort=[("bucket", DESCENDING)],
+            limit=max(1, limit_buckets),
+        )
+        return [n async for b in cur for n in b.get("notes", [])]
+
     # ---------- outbox ----------
+    async def _migrate_outbox(self) -> None:
+        """
+        Идемпотентный backfill старых записей outbox: ISO-строки -> BSON Date
+        (иначе {"nextAttemptAt": {"$lte": datetime}} их не видит),
+        lockUntil None -> EPOCH, недостающий hashSlot.
+        Непарсящаяся строка остаётся как есть (не валит весь update_many).
+        """
+        fields = ("createdAt", "updatedAt", "nextAttemptAt", "lockUntil", "sentAt", "failedAt")
+        conv = {
+            f: {"$cond": [
+                {"$eq": [{"$type": f"${f}"}, "string"]},
+                {"$convert": {"input": f"${f}", "to": "date", "onError": f"${f}", "onNull": None}},
+                f"${f}",
+            ]}
+            for f in fields
+        }
+        res = await self.ops_outbox.update_many(
+            {"$or": [{f: {"$type": "string"}} for f in fields]},
+            [{"$set": conv}],
+        )
+        if res.modified_count:
+            log.info("Mongo outbox: %s doc(s) migrated to BSON Date", res.modified_count)
+
+        # lockUntil: None -> EPOCH (claim больше не ищет null)
+        res = await self.ops_outbox.update_many({"lockUntil": None}, {"$set": {"lockUntil": EPOCH}})
+        if res.modified_count:
+            log.info("Mongo outbox: %s doc(s) lockUntil None -> EPOCH", res.modified_count)
+
+        # hashSlot для записей, созданных до шардирования воркеров (crc32 считаем здесь)
+        ops = [
+            UpdateOne({"_id": d["_id"]}, {"$set": {"hashSlot": _hash_slot(d.get("caseId") or "")}})
+            async for d in self.ops_outbox.find({"hashSlot": {"$exists": False}}, {"caseId": 1})
+        ]
+        if ops:
+            await self.ops_outbox.bulk_write(ops, ordered=False)
+            log.info("Mongo outbox: %s doc(s) got hashSlot", len(ops))
+
     async def enqueue_ops_outbox(
         self,
         *,
@@ -278,13 +895,16 @@ class MongoStore:
         text: str,
         source: Dict[str, Any],
         target: Dict[str, Any],
+        now: Optional[datetime] = None,
     ) -> None:
         if not self.enabled or self.ops_outbox is None:
             return
 
-        now = utcnow().isoformat()
+        now = now or utcnow()
+        key = _outbox_key(kind, case_id, text, target)
 
         doc_set = {
+            "idempotencyKey": key,
             "caseType": case_type,
             "text": text,
             "source": source,
@@ -292,90 +912,218 @@ class MongoStore:
             "status": "pending",
             "updatedAt": now,
             "nextAttemptAt": now,
-            "lockUntil": None,
+            "lockUntil": EPOCH,
         }
 
         doc_insert = {
             "kind": kind,
             "caseId": case_id,
+            "hashSlot": _hash_slot(case_id),
             "attempts": 0,
             "createdAt": now,
         }
 
-        await self.ops_outbox.update_one(
-            {"kind": kind, "caseId": case_id},
-            {"$set": doc_set, "$setOnInsert": doc_insert},
-            upsert=True,
-        )
+        # тот же payload повторно: фильтр не совпадёт, upsert упрётся в unique (kind, caseId)
+        # — запись не трогаем и уже отправленное не уходит второй раз
+        try:
+            await self.ops_outbox.update_one(
+                {"kind": kind, "caseId": case_id, "idempotencyKey": {"$ne": key}},
+                {"$set": doc_set, "$setOnInsert": doc_insert},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            log.info("Mongo outbox duplicate skipped kind=%s caseId=%s", kind, case_id)
+
+    def _claim_hint_kw(self) -> Dict[str, Any]:
+        # план claim фиксируем на partial-индексе: без раздумий планировщика
+        return {"hint": _CLAIM_INDEX} if self._claim_hint else {}
+
+    def _drop_claim_hint(self, e: OperationFailure) -> bool:
+        # индекса нет (не создался / переименован) — один раз отключаем hint и идём без него;
+        # по одному code 2 (BadValue) не решаем — так сервер отвечает и на другие ошибки запроса
+        if self._claim_hint and "hint" in str(e).lower():
+            log.warning("Mongo outbox claim hint %s rejected, claiming without it: %s", _CLAIM_INDEX, e)
+            self._claim_hint = False
+            return True
+        return False
 
     async def claim_pending_outbox(self) -> Optional[Dict[str, Any]]:
         if not self.enabled or self.ops_outbox is None:
             return None
 
-        now_dt = utcnow()
-        now = now_dt.isoformat()
+        now = utcnow()
+        lock_until = now + timedelta(seconds=_lock_seconds())
+        q = _claim_filter(now)
 
-        # ✅ фикс: поддерживаем оба названия env (чтобы не было "0" или None)
-        lock_seconds = int(
-            getattr(settings, "OPS_LOCK_SECONDS", None)
-            or getattr(settings, "OPS_WORKER_LOCK_SECONDS", None)
-            or 60
-        )
-        max_attempts = int(getattr(settings, "OPS_MAX_ATTEMPTS", 10) or 10)
+        upd = {"$set": {"status": "sending", "lockUntil": lock_until, "updatedAt": now}}
 
-        lock_until = (now_dt + timedelta(seconds=lock_seconds)).isoformat()
+        try:
+            return await self.ops_outbox.find_one_and_update(
+                q,
+                upd,
+                sort=_CLAIM_SORT,
+                return_document=ReturnDocument.AFTER,
+                maxTimeMS=_claim_max_time_ms(),
+                **self._claim_hint_kw(),
+            )
+        except ExecutionTimeout as e:
+            # claim дольше OPS_CLAIM_MAX_TIME_MS — пропускаем круг, воркер повторит после паузы
+            log.warning("Mongo outbox claim timed out: %s", e)
+            return None
+        except OperationFailure as e:
+            if not self._drop_claim_hint(e):
+                raise
+            return await self.claim_pending_outbox()
 
-        q = {
-            "status": "pending",
-            "nextAttemptAt": {"$lte": now},
-            "attempts": {"$lt": max_attempts},
-            "$or": [{"lockUntil": None}, {"lockUntil": {"$lte": now}}],
-        }
+    async def claim_pending_outbox_batch(self, k: int) -> List[Dict[str, Any]]:
+        """
+        Забрать до k записей за 3 запроса вместо k find_one_and_update:
+        find _id -> update_many (лочим своим claimId) -> find по claimId.
+        Что успел перехватить другой воркер, в выборку не попадёт.
+        """
+        if not self.enabled or self.ops_outbox is None or k <= 0:
+            return []
 
-        upd = {"$set": {"status": "sending", "lockUntil": lock_until, "updatedAt": now}}
+        now = utcnow()
+        q = _claim_filter(now)
 
-        doc = await self.ops_outbox.find_one_and_update(
-            q,
-            upd,
-            sort=[("nextAttemptAt", ASCENDING), ("createdAt", ASCENDING)],
-            return_document=ReturnDocument.AFTER,
+        try:
+            ids = [
+                d["_id"]
+                async for d in self.ops_outbox.find(
+                    q,
+                    {"_id": 1},
+                    sort=_CLAIM_SORT,
+                    limit=k,
+                    max_time_ms=_claim_max_time_ms(),
+                    **self._claim_hint_kw(),
+                )
+            ]
+        except ExecutionTimeout as e:
+            log.warning("Mongo outbox claim timed out: %s", e)
+            return []
+        except OperationFailure as e:
+            if not self._drop_claim_hint(e):
+                raise
+            return await self.claim_pending_outbox_batch(k)
+        if not ids:
+            return []
+
+        claim_id = ObjectId()
+        await self.ops_outbox.update_many(
+            {**q, "_id": {"$in": ids}},
+            {"$set": {
+                "status": "sending",
+                "lockUntil": now + timedelta(seconds=_lock_seconds()),
+                "updatedAt": now,
+                "claimId": claim_id,
+            }},
         )
-        return doc
+        return await self.ops_outbox.find({"_id": {"$in": ids}, "claimId": claim_id}).to_list(length=k)
 
-    async def mark_outbox_sent(self, outbox_id, resp: Optional[Dict[str, Any]] = None) -> None:
+    async def watch_outbox(self, wake: asyncio.Event) -> None:
+        """
+        Change stream по outbox: новая/возвращённая в pending запись -> wake.set().
+        Нужен replica set; на standalone (или при обрыве) просто выходим —
+        воркер продолжит опрашивать по таймеру.
+        """
         if not self.enabled or self.ops_outbox is None:
             return
-        now = utcnow().isoformat()
-        await self.ops_outbox.update_one(
-            {"_id": outbox_id},
-            {"$set": {"status": "sent", "sentAt": now, "updatedAt": now, "lockUntil": None, "lastResponse": resp or None}},
-        )
+        pipeline = [{"$match": {
+            "operationType": {"$in": ["insert", "update", "replace"]},
+            "fullDocument.status": "pending",
+        }}]
+        try:
+            async with await self.ops_outbox.watch(pipeline, full_document="updateLookup") as stream:
+                async for _ in stream:
+                    wake.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("Mongo outbox change stream stopped, falling back to polling: %s", e)
 
-    async def mark_outbox_failed(self, outbox_id, error: str, attempts: int) -> None:
+    async def next_outbox_attempt_at(self) -> Optional[datetime]:
+        """
+        Ближайший nextAttemptAt среди pending-записей этого воркера (None — нет
+        или запрос не удался): change stream будит на постановку ретрая, а не на его срок.
+        """
         if not self.enabled or self.ops_outbox is None:
-            return
+            return None
+        q: Dict[str, Any] = {"status": "pending"}
+        q.update(_claim_static())
+        try:
+            doc = await self.ops_outbox.find_one(
+                q,
+                {"nextAttemptAt": 1, "_id": 0},
+                sort=_CLAIM_SORT,
+                max_time_ms=_claim_max_time_ms(),
+                **self._claim_hint_kw(),
+            )
+        except Exception as e:
+            log.warning("Mongo outbox next attempt lookup failed: %s", e)
+            return None
+        due = (doc or {}).get("nextAttemptAt")
+        return due if isinstance(due, datetime) else None
 
+    @staticmethod
+    def _outbox_sent_update(resp: Optional[Dict[str, Any]], now: datetime) -> Dict[str, Any]:
+        return {"$set": {"status": "sent", "sentAt": now, "updatedAt": now, "lockUntil": EPOCH, "lastResponse": resp or None}}
+
+    @staticmethod
+    def _outbox_failed_update(error: str, attempts: int, now: datetime) -> Dict[str, Any]:
         base = int(getattr(settings, "OPS_BACKOFF_BASE_SECONDS", 10) or 10)
         cap = int(getattr(settings, "OPS_BACKOFF_MAX_SECONDS", 600) or 600)
         max_attempts = int(getattr(settings, "OPS_MAX_ATTEMPTS", 10) or 10)
 
+        if attempts >= max_attempts:
+            return {"$set": {"status": "failed", "failedAt": now, "updatedAt": now, "lockUntil": EPOCH, "lastError": error}}
+
         delay = min(cap, base * (2 ** max(0, attempts - 1)))
+        return {
+            "$set": {
+                "status": "pending",
+                "updatedAt": now,
+                "lockUntil": EPOCH,
+                "lastError": error,
+                "nextAttemptAt": now + timedelta(seconds=delay),
+            },
+            "$inc": {"attempts": 1},
+        }
 
-        now_dt = utcnow()
-        now = now_dt.isoformat()
-        next_at = (now_dt + timedelta(seconds=delay)).isoformat()
+    async def mark_outbox_sent(
+        self,
+        outbox_id,
+        resp: Optional[Dict[str, Any]] = None,
+        *,
+        now: Optional[datetime] = None,
+    ) -> None:
+        if not self.enabled or self.ops_outbox is None:
+            return
+        await self.ops_outbox.update_one({"_id": outbox_id}, self._outbox_sent_update(resp, now or utcnow()))
 
-        if attempts >= max_attempts:
-            await self.ops_outbox.update_one(
-                {"_id": outbox_id},
-                {"$set": {"status": "failed", "failedAt": now, "updatedAt": now, "lockUntil": None, "lastError": error}},
-            )
+    async def mark_outbox_failed(self, outbox_id, error: str, attempts: int, *, now: Optional[datetime] = None) -> None:
+        if not self.enabled or self.ops_outbox is None:
             return
+        await self.ops_outbox.update_one({"_id": outbox_id}, self._outbox_failed_update(error, attempts, now or utcnow()))
 
-        await self.ops_outbox.update_one(
-            {"_id": outbox_id},
-            {
-                "$set": {"status": "pending", "updatedAt": now, "lockUntil": None, "lastError": error, "nextAttemptAt": next_at},
-                "$inc": {"attempts": 1},
-            },
-        )
+    async def mark_outbox_results(
+        self,
+        results: List[Tuple[Any, bool, Any, int]],
+        *,
+        now: Optional[datetime] = None,
+    ) -> None:
+        """
+        Итоги пачки отправок одним bulk_write вместо update_one на каждую.
+        results: (outbox_id, ok, resp | error, attempts)
+        """
+        if not self.enabled or self.ops_outbox is None or not results:
+            return
+        now = now or utcnow()
+        ops = [
+            UpdateOne(
+                {"_id": oid},
+                self._outbox_sent_update(payload, now) if ok else self._outbox_failed_update(str(payload), attempts, now),
+            )
+            for oid, ok, payload, attempts in results
+        ]
+        await self.ops_outbox.bulk_write(ops, ordered=False)
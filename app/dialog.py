@@ -2,17 +2,89 @@
 
 from __future__ import annotations
 
+from contextvars import ContextVar
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple
 import datetime as dt
+import functools
 import re
-import secrets
+import os
 import logging
 
-from .nlu import build_nlu, extract_train_and_car, detect_aggression_and_flood, normalize
+from .nlu import build_nlu, extract_train_and_car, detect_aggression_and_flood, keyword_re, normalize
 
 log = logging.getLogger("ktzh")
 
+# регэкспы разбора сообщений — компилируем один раз при импорте
+_RE_TRAIN_SLASH = re.compile(r"\b(\d{1,3}\s*/\s*\d{1,3})\b")
+_RE_TRAIN_ALPHA = re.compile(r"\b(\d{1,4}\s*[a-zа-я]{1,3})\b")
+_RE_TRAIN_ANY = re.compile(
+    r"\b(?:(?P<sl>\d{1,3}\s*/\s*\d{1,3})\b"
+    r"|(?P<al>\d{1,4}\s*[a-zа-я]{1,3})\b"
+    r"|поезд\s*(?P<pz>\d{1,3}(?:\s*/\s*\d{1,3})?)\b)"
+)
+_RE_TOKENS = re.compile(r"[a-zа-я0-9/]+")
+_RE_DURATION = re.compile(r"\bна\s*\d+\s*(час|ч|минут|мин)\b")
+_RE_COUPE = re.compile(r"\bкупе\s*(\d{1,2})\b")
+_RE_SEAT = re.compile(r"\bместо\s*(\d{1,2})\b|\b(\d{1,2})\s*место\b")
+_RE_DATE = re.compile(r"\b(\d{1,2})[.\-/](\d{1,2})(?:[.\-/](\d{2,4}))?\b")
+_RE_TIME = re.compile(r"\b(\d{1,2}):(\d{2})\b")
+_RE_123 = re.compile(r"(?:^|(?<=\s))([123])\)(.*?)(?=\s+[123]\)|\s*$)", re.S)
+_RE_CLEAN = re.compile(r"[^a-zа-я0-9\s]+")
+_RE_ALNUM_STRIP = re.compile(r"[^a-zа-я0-9]+")
+
+
+# постоянные наборы слов — frozenset один раз при импорте
+_BASE_ALLOWED_TOKENS = frozenset(("т", "t", "вагон", "поезд"))
+_NO_MORE_ONE_WORD = frozenset(("нет", "нету", "неа", "ничего", "нечего", "всё", "все"))
+_PUNCT_NOISE = frozenset(("?", "??", "???", "!", "!!", "...", "…"))
+_ACK_NOISE = frozenset(("ок", "понял", "ясно", "я же написал", "я написал"))
+_STOP_WORDS = frozenset(("стоп", "хватит", "отмена", "прекрати", "прекратите"))
+
+
+# признаки сообщения — чистые функции текста: handle()/_apply_pending спрашивают
+# их по многу раз (train/car, «только поезд», generic, ...), поэтому каждый
+# признак считается по тексту один раз, дальше — из кэша
+_text_memo = functools.lru_cache(maxsize=1024)
+
+
+_KW_COMPLAINT = keyword_re((
+    "хочу пожаловаться",
+    "хочу жалобу",
+    "хочу оставить жалобу",
+    "у меня жалоба",
+    "жалоба",
+    "пожаловаться",
+))
+_KW_GRATITUDE = keyword_re(("хочу поблагодарить", "хочу сказать спасибо", "у меня благодарность", "благодарность", "спасибо"))
+_KW_DELAY = keyword_re(("опозд", "опазд", "задерж"))
+_KW_ITEM = keyword_re((
+    "сумк", "рюкзак", "чемодан", "пакет",
+    "телефон", "документ", "паспорт",
+    "кошелек", "бумажник", "наушник", "ноутбук",
+    "кофт", "куртк", "одежд", "футболк", "штан", "джинс", "пальт", "шапк",
+))
+_KW_NEW_CASE = keyword_re((
+    "новая заявка",
+    "новое обращение",
+    "новый тикет",
+    "новая жалоба",
+    "создай новую",
+    "начать заново",
+    "новая",
+))
+_KW_NO_MORE = keyword_re((
+    "нечего добавить",
+    "добавить нечего",
+    "больше нечего",
+    "больше нет",
+    "ничего больше",
+    "это все",
+    "это всё",
+    "все сказал",
+    "всё сказал",
+))
+
 
 @dataclass
 class BotReply:
@@ -20,15 +92,35 @@ class BotReply:
     meta: Dict[str, Any] | None = None
 
 
+_UTC = dt.timezone.utc
+
+
 def _now_utc() -> dt.datetime:
-    return dt.datetime.now(dt.timezone.utc)
+    return dt.datetime.now(_UTC)
+
+
+# время текущего хода handle(): одна ISO-строка на все метки сессии/кейсов за ход
+_turn_iso: ContextVar[Optional[str]] = ContextVar("turn_iso", default=None)
+
+
+def _now_iso() -> str:
+    # метки времени сессии/кейса хранятся строками ISO
+    return _turn_iso.get() or dt.datetime.now(_UTC).isoformat()
+
+
+_day_cache: Tuple[int, str] = (0, "")
 
 
 def _gen_case_id(prefix: str, chat_id_hash: str) -> str:
-    d = _now_utc().strftime("%Y%m%d")
+    # дата меняется раз в сутки — strftime только при смене дня
+    global _day_cache
+    now = _now_utc()
+    day = now.toordinal()
+    if _day_cache[0] != day:
+        _day_cache = (day, now.strftime("%Y%m%d"))
     short_chat = chat_id_hash[:6].upper()
-    rnd = secrets.token_hex(3).upper()
-    return f"{prefix}-{d}-{short_chat}-{rnd}"
+    rnd = os.urandom(3).hex().upper()
+    return f"{prefix}-{_day_cache[1]}-{short_chat}-{rnd}"
 
 
 def _short(text: str) -> str:
@@ -36,32 +128,36 @@ def _short(text: str) -> str:
 
 
 def _is_only_number(text: str) -> Optional[int]:
+    # normalize уже обрезал пробелы; isdecimal == \d (isdigit пропустил бы «²»)
     t = normalize(text)
-    m = re.fullmatch(r"\s*(\d{1,2})\s*", t)
-    if not m:
+    if len(t) > 2 or not t.isdecimal():
         return None
-    v = int(m.group(1))
+    v = int(t)
     return v if 1 <= v <= 99 else None
 
 
 def _extract_train_fallback(text: str) -> Optional[str]:
     tn = normalize(text)
 
-    m = re.search(r"\b(\d{1,3}\s*/\s*\d{1,3})\b", tn)
-    if m:
-        return m.group(1).replace(" ", "").upper()
-
-    m = re.search(r"\b(\d{1,4}\s*[a-zа-я]{1,3})\b", tn)
-    if m:
-        return m.group(1).replace(" ", "").upper()
+    # один проход: в тексте нет ни одного формата поезда (частый случай) — сразу None
+    m = _RE_TRAIN_ANY.search(tn)
+    if not m:
+        return None
 
-    m = re.search(r"\bпоезд\s*(\d{1,3}(?:\s*/\s*\d{1,3})?)\b", tn)
-    if m:
-        return m.group(1).replace(" ", "").upper()
+    # приоритет: «81/82» > «10ца» > «поезд 12». Ветки _RE_TRAIN_ANY в том же порядке,
+    # так что левее m.start() более приоритетных совпадений нет — добираем только правее
+    kind = m.lastgroup
+    if kind != "sl":
+        hit = _RE_TRAIN_SLASH.search(tn, m.start())
+        if not hit and kind == "pz":
+            hit = _RE_TRAIN_ALPHA.search(tn, m.start())
+        if hit:
+            return hit.group(1).replace(" ", "").upper()
 
-    return None
+    return m.group(kind).replace(" ", "").upper()
 
 
+@_text_memo
 def _extract_train_car_any(text: str) -> Tuple[Optional[str], Optional[int]]:
     tr, car = extract_train_and_car(text)
     if not tr:
@@ -69,63 +165,63 @@ def _extract_train_car_any(text: str) -> Tuple[Optional[str], Optional[int]]:
     return tr, car
 
 
+@_text_memo
 def _is_train_car_only(text: str) -> bool:
     tn = normalize(text)
     tr, car = _extract_train_car_any(text)
-    tokens = re.findall(r"[a-zа-я0-9/]+", tn)
+    tokens = _RE_TOKENS.findall(tn)
     if not tokens:
         return False
 
-    allowed = {"т", "t", "вагон", "поезд"}
+    allowed = _BASE_ALLOWED_TOKENS
+    extra = []
     if tr:
-        allowed.add(normalize(tr))
-        allowed.add(normalize(tr).replace("т", "").strip())
+        ntr = normalize(tr)
+        extra += (ntr, ntr.replace("т", "").strip())
     if car is not None:
-        allowed.add(str(car))
+        extra.append(str(car))
+    if extra:
+        allowed = allowed.union(extra)
 
     meaningful = [x for x in tokens if x not in allowed]
     return len(meaningful) <= 1 and len(tokens) <= 6
 
 
+@_text_memo
 def _is_generic_complaint(text: str) -> bool:
     tn = normalize(text)
-    generic = (
-        "хочу пожаловаться",
-        "хочу жалобу",
-        "хочу оставить жалобу",
-        "у меня жалоба",
-        "жалоба",
-        "пожаловаться",
-    )
-    return any(g in tn for g in generic) and len(tn.split()) <= 6
+    return len(tn.split()) <= 6 and _KW_COMPLAINT.search(tn) is not None
 
 
+@_text_memo
 def _is_generic_gratitude(text: str) -> bool:
     tn = normalize(text)
-    generic = ("хочу поблагодарить", "хочу сказать спасибо", "у меня благодарность", "благодарность", "спасибо")
-    return any(g in tn for g in generic) and len(tn.split()) <= 6
+    return len(tn.split()) <= 6 and _KW_GRATITUDE.search(tn) is not None
 
 
+@_text_memo
 def _is_delay_complaint(text: str) -> bool:
     tn = normalize(text)
-    if any(k in tn for k in ("опозд", "опазд", "задерж")):
+    if _KW_DELAY.search(tn):
         return True
-    return bool(re.search(r"\bна\s*\d+\s*(час|ч|минут|мин)\b", tn))
+    return bool(_RE_DURATION.search(tn))
 
 
+@_text_memo
 def _extract_place(text: str) -> Optional[str]:
     t = normalize(text)
 
     coupe = None
     seat = None
 
-    m = re.search(r"\bкупе\s*(\d{1,2})\b", t)
+    m = _RE_COUPE.search(t)
     if m:
         coupe = m.group(1)
 
-    m = re.search(r"\bместо\s*(\d{1,2})\b|\b(\d{1,2})\s*место\b", t)
+    m = _RE_SEAT.search(t)
     if m:
-        seat = next((g for g in m.groups() if g and g.isdigit()), None)
+        # сработала ровно одна из двух веток: «место 12» или «12 место»
+        seat = m.group(1) or m.group(2)
 
     if "тамбур" in t:
         return "тамбур"
@@ -145,6 +241,7 @@ def _extract_place(text: str) -> Optional[str]:
     return None
 
 
+@_text_memo
 def _extract_when(text: str) -> Optional[str]:
     tn = normalize(text)
 
@@ -157,13 +254,13 @@ def _extract_when(text: str) -> Optional[str]:
         day = "позавчера"
 
     date = None
-    m = re.search(r"\b(\d{1,2})[.\-/](\d{1,2})(?:[.\-/](\d{2,4}))?\b", tn)
+    m = _RE_DATE.search(tn)
     if m:
         d, mo, y = m.group(1), m.group(2), m.group(3)
         date = f"{d.zfill(2)}.{mo.zfill(2)}.{y}" if y else f"{d.zfill(2)}.{mo.zfill(2)}"
 
     tm = None
-    m = re.search(r"\b(\d{1,2}):(\d{2})\b", tn)
+    m = _RE_TIME.search(tn)
     if m:
         tm = f"{m.group(1).zfill(2)}:{m.group(2)}"
 
@@ -174,101 +271,78 @@ def _extract_when(text: str) -> Optional[str]:
     return day or date or tm
 
 
+@_text_memo
 def _extract_item(text: str) -> Optional[str]:
     tn = normalize(text)
-    keys = (
-        "сумк", "рюкзак", "чемодан", "пакет",
-        "телефон", "документ", "паспорт",
-        "кошелек", "бумажник", "наушник", "ноутбук",
-        "кофт", "куртк", "одежд", "футболк", "штан", "джинс", "пальт", "шапк",
-    )
-    return _short(text) if any(k in tn for k in keys) else None
+    return _short(text) if _KW_ITEM.search(tn) else None
 
 
-def _split_123(text: str) -> Dict[str, str]:
-    s = (text or "").strip()
-    out: Dict[str, str] = {}
+# слот кейса -> извлекатель из текста (порядок как в _apply_pending)
+_SLOT_EXTRACTORS = (
+    ("complaintWhen", _extract_when),
+    ("place", _extract_place),
+    ("when", _extract_when),
+    ("item", _extract_item),
+)
 
-    m1 = re.search(r"(?:^|\s)1\)\s*(.+?)(?=(?:\s*\b2\)\b|\s*$))", s, flags=re.S)
-    if m1:
-        out["1"] = m1.group(1).strip()
 
-    m2 = re.search(r"(?:^|\s)2\)\s*(.+?)(?=(?:\s*\b3\)\b|\s*$))", s, flags=re.S)
-    if m2:
-        out["2"] = m2.group(1).strip()
+def _split_123(text: str) -> Dict[str, str]:
+    # один проход: каждый пункт — до следующего маркера «N)» или до конца;
+    # пустые пункты пропускаем, при повторе маркера берём первый
+    out: Dict[str, str] = {}
+    for m in _RE_123.finditer((text or "").strip()):
+        v = m.group(2).strip()
+        if v:
+            out.setdefault(m.group(1), v)
+    return out
 
-    m3 = re.search(r"(?:^|\s)3\)\s*(.+?)\s*$", s, flags=re.S)
-    if m3:
-        out["3"] = m3.group(1).strip()
 
-    return out
+_CASE_TITLES: Dict[str, str] = {
+    "lost": "Забытые/потерянные вещи",
+    "complaint": "Жалоба",
+    "gratitude": "Благодарность",
+}
 
 
 def _case_title(case_type: str) -> str:
-    return {
-        "lost": "Забытые/потерянные вещи",
-        "complaint": "Жалоба",
-        "gratitude": "Благодарность",
-    }.get(case_type, case_type)
+    return _CASE_TITLES.get(case_type, case_type)
 
 
+@_text_memo
 def _is_new_case_command(text: str) -> bool:
     tn = normalize(text)
-    keys = (
-        "новая заявка",
-        "новое обращение",
-        "новый тикет",
-        "новая жалоба",
-        "создай новую",
-        "начать заново",
-        "новая",
-    )
-    return any(k in tn for k in keys)
+    return _KW_NEW_CASE.search(tn) is not None
 
 
+@_text_memo
 def _is_no_more_details(text: str) -> bool:
     tn = normalize(text).strip()
     if not tn:
         return False
 
-    clean = re.sub(r"[^a-zа-я0-9\s]+", " ", tn).strip()
+    clean = _RE_CLEAN.sub(" ", tn).strip()
     words = [w for w in clean.split() if w]
     if not words:
         return False
 
-    one_word = {"нет", "нету", "неа", "ничего", "нечего", "всё", "все"}
-    if len(words) == 1 and words[0] in one_word:
+    if len(words) == 1 and words[0] in _NO_MORE_ONE_WORD:
         return True
 
-    joined = " ".join(words)
-    phrases = (
-        "нечего добавить",
-        "добавить нечего",
-        "больше нечего",
-        "больше нет",
-        "ничего больше",
-        "это все",
-        "это всё",
-        "все сказал",
-        "всё сказал",
-    )
-    return len(words) <= 4 and any(p in joined for p in phrases)
+    return len(words) <= 4 and _KW_NO_MORE.search(" ".join(words)) is not None
 
 
+@_text_memo
 def _is_followup_noise(text: str) -> bool:
     tn = normalize(text).strip()
-    if not tn:
-        return True
-    if _is_train_car_only(text):
+    # от дешёвых проверок к дорогим; порог по длине тут не годится —
+    # «поезд т58 вагон 7 …» и generic-жалоба бывают длиннее 40 символов
+    if not tn or tn in _PUNCT_NOISE or tn in _ACK_NOISE:
         return True
-    if tn in {"?", "??", "???", "!", "!!", "...", "…"}:
-        return True
-    if tn in {"ок", "понял", "ясно", "я же написал", "я написал"}:
+    if len(_RE_ALNUM_STRIP.sub("", tn)) <= 2:
         return True
     if _is_generic_complaint(text) or _is_generic_gratitude(text):
         return True
-    alnum = re.sub(r"[^a-zа-я0-9]+", "", tn)
-    return len(alnum) <= 2
+    return _is_train_car_only(text)
 
 
 def _fmt_ops_text(case_id: str, case_type: str, session: Dict[str, Any], chat_meta: Dict[str, Any], case: Dict[str, Any]) -> str:
@@ -311,6 +385,41 @@ def _fmt_ops_text(case_id: str, case_type: str, session: Dict[str, Any], chat_me
     return "\n".join(lines).strip()
 
 
+# кейс ещё «жив» (собираем данные или уже отправлен OPS); порядок выбора основного
+_ACTIVE_STATUSES = frozenset(("open", "collecting"))
+_CASE_PRIORITY = ("lost", "complaint", "gratitude")
+
+def _build_case_index(session: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    # тип -> активные кейсы этого типа (в порядке session["cases"])
+    by_type: Dict[str, List[Dict[str, Any]]] = {}
+    for c in session["cases"]:
+        if c["status"] in _ACTIVE_STATUSES:
+            by_type.setdefault(c["type"], []).append(c)
+    return by_type
+
+
+# тексты подсказок неизменны — собираем один раз при импорте
+_QUESTION_PREFIX: Dict[str, str] = {
+    "complaint": "Чтобы оформить жалобу",
+    "gratitude": "Чтобы оформить благодарность",
+    "lost": "Чтобы помочь найти вещь",
+}
+
+_OPS_TEMPLATE = (
+    "Похоже, я не могу корректно оформить заявку автоматически.\n"
+    "Пожалуйста, отправьте одним сообщением для оперативников по шаблону:\n\n"
+    "1) Тип обращения: ЖАЛОБА / ПОТЕРЯЛ(А) ВЕЩЬ / БЛАГОДАРНОСТЬ\n"
+    "2) Поезд № (например: Т78 или 10ЦА или 81/82 или ТЦ10):\n"
+    "3) Маршрут (откуда–куда):\n"
+    "4) Дата поездки (дд.мм.гггг):\n"
+    "5) Время/примерно когда:\n"
+    "6) Вагон № (если относится к вагону):\n"
+    "7) Место/купе (если есть):\n"
+    "8) Детали обращения (2–4 предложения):\n"
+)
+_OPS_TEMPLATE_LOST = _OPS_TEMPLATE.replace("8) Детали обращения", "8) Что потеряли + приметы (цвет/марка) и где оставили")
+
+
 class DialogManager:
     def __init__(self, store: Any):
         self.store = store
@@ -329,8 +438,8 @@ class DialogManager:
                 "moderation": {"prev_text": None, "repeat_count": 0, "last_ts": 0.0},
                 "loop": {"key": None, "count": 0},
                 "mode": "normal",  # normal | new_case
-                "createdAt": _now_utc().isoformat(),
-                "updatedAt": _now_utc().isoformat(),
+                "createdAt": _now_iso(),
+                "updatedAt": _now_iso(),
             }
         if "loop" not in s:
             s["loop"] = {"key": None, "count": 0}
@@ -339,7 +448,7 @@ class DialogManager:
         return s
 
     async def _save_session(self, chat_id_hash: str, session: Dict[str, Any]) -> None:
-        session["updatedAt"] = _now_utc().isoformat()
+        session["updatedAt"] = _now_iso()
         if hasattr(self.store, "save_session"):
             await self.store.save_session(chat_id_hash, session)
 
@@ -358,25 +467,11 @@ class DialogManager:
         session["loop"] = {"key": None, "count": 0}
 
     def _ops_template(self, case_type: str) -> str:
-        base = (
-            "Похоже, я не могу корректно оформить заявку автоматически.\n"
-            "Пожалуйста, отправьте одним сообщением для оперативников по шаблону:\n\n"
-            "1) Тип обращения: ЖАЛОБА / ПОТЕРЯЛ(А) ВЕЩЬ / БЛАГОДАРНОСТЬ\n"
-            "2) Поезд № (например: Т78 или 10ЦА или 81/82 или ТЦ10):\n"
-            "3) Маршрут (откуда–куда):\n"
-            "4) Дата поездки (дд.мм.гггг):\n"
-            "5) Время/примерно когда:\n"
-            "6) Вагон № (если относится к вагону):\n"
-            "7) Место/купе (если есть):\n"
-            "8) Детали обращения (2–4 предложения):\n"
-        )
-        if case_type == "lost":
-            return base.replace("8) Детали обращения", "8) Что потеряли + приметы (цвет/марка) и где оставили")
-        return base
+        return _OPS_TEMPLATE_LOST if case_type == "lost" else _OPS_TEMPLATE
 
     def _get_or_create_case(self, session: Dict[str, Any], case_type: str) -> Dict[str, Any]:
         for c in session["cases"]:
-            if c["type"] == case_type and c["status"] in ("open", "collecting"):
+            if c["type"] == case_type and c["status"] in _ACTIVE_STATUSES:
                 return c
 
         c = {
@@ -393,7 +488,7 @@ class DialogManager:
                 "staffName": None,
             },
             "caseId": None,
-            "createdAt": _now_utc().isoformat(),
+            "createdAt": _now_iso(),
         }
         session["cases"].append(c)
         return c
@@ -406,10 +501,10 @@ class DialogManager:
 
     def _close_all_cases(self, session: Dict[str, Any], reason: str) -> None:
         for c in session["cases"]:
-            if c["status"] in ("open", "collecting"):
+            if c["status"] in _ACTIVE_STATUSES:
                 c["status"] = "closed"
                 c["closeReason"] = reason
-                c["closedAt"] = _now_utc().isoformat()
+                c["closedAt"] = _now_iso()
         session["pending"] = None
         self._loop_reset(session)
 
@@ -417,11 +512,7 @@ class DialogManager:
         session["pending"] = {"scope": scope, "slots": slots, "caseType": case_type}
 
     def _train_car_question_for(self, case_type: str, missing_train: bool, missing_car: bool) -> str:
-        prefix = {
-            "complaint": "Чтобы оформить жалобу",
-            "gratitude": "Чтобы оформить благодарность",
-            "lost": "Чтобы помочь найти вещь",
-        }.get(case_type, "Чтобы продолжить")
+        prefix = _QUESTION_PREFIX.get(case_type, "Чтобы продолжить")
 
         if missing_train and missing_car:
             return f"{prefix}, напишите номер поезда и вагон одним сообщением (пример: Т58, 7 вагон)."
@@ -478,7 +569,7 @@ class DialogManager:
         case_id = _gen_case_id("KTZH", chat_id_hash)
         case["caseId"] = case_id
         case["status"] = "open"
-        case["openedAt"] = _now_utc().isoformat()
+        case["openedAt"] = _now_iso()
 
         if hasattr(self.store, "create_case"):
             await self.store.create_case({
@@ -488,7 +579,7 @@ class DialogManager:
                 "type": case["type"],
                 "status": "open",
                 "payload": {"shared": session.get("shared"), "slots": case.get("slots"), "followups": []},
-            })
+            }, copy=False)
 
         self._loop_reset(session)
         return case_id
@@ -560,31 +651,16 @@ class DialogManager:
                         cs["when"] = wh
                         changed = True
 
-            if case_type == "complaint":
-                if "complaintWhen" in slots and not cs.get("complaintWhen"):
-                    wh = _extract_when(text)
-                    if wh:
-                        cs["complaintWhen"] = wh
+            # слоты, которые заполняются извлечением из всего текста
+            for sname, extract in _SLOT_EXTRACTORS:
+                if sname == "complaintWhen" and case_type != "complaint":
+                    continue
+                if sname in slots and not cs.get(sname):
+                    val = extract(text)
+                    if val:
+                        cs[sname] = val
                         changed = True
 
-            if "place" in slots and not cs.get("place"):
-                pl = _extract_place(text)
-                if pl:
-                    cs["place"] = pl
-                    changed = True
-
-            if "when" in slots and not cs.get("when"):
-                wh = _extract_when(text)
-                if wh:
-                    cs["when"] = wh
-                    changed = True
-
-            if "item" in slots and not cs.get("item"):
-                it = _extract_item(text)
-                if it:
-                    cs["item"] = it
-                    changed = True
-
             if "complaintText" in slots and not cs.get("complaintText"):
                 if (not _is_train_car_only(text)) and (not _is_generic_complaint(text)):
                     cs["complaintText"] = _short(text)
@@ -627,7 +703,7 @@ class DialogManager:
             return False
         try:
             note = {
-                "ts": _now_utc().isoformat(),
+                "ts": _now_iso(),
                 "text": _short(text),
                 "meta": {
                     "chatId": str(chat_meta.get("chatId") or ""),
@@ -635,7 +711,8 @@ class DialogManager:
                     "channelId": str(chat_meta.get("channelId") or ""),
                 },
             }
-            ok = await self.store.append_case_followup(case_id, note)  # type: ignore[attr-defined]
+            # note собран здесь и больше не нужен — store может не копировать
+            ok = await self.store.append_case_followup(case_id, note, copy=False)  # type: ignore[attr-defined]
             return bool(ok)
         except Exception as e:
             log.warning("append_case_followup failed for %s: %s", case_id, e)
@@ -645,8 +722,17 @@ class DialogManager:
         return any(c.get("status") == "collecting" for c in (session.get("cases") or []))
 
     async def handle(self, chat_id_hash: str, chat_meta: Dict[str, Any], user_text: str) -> BotReply:
-        session = await self._load_session(chat_id_hash)
+        token = _turn_iso.set(_now_iso())
+        try:
+            session = await self._load_session(chat_id_hash)
+            reply = await self._handle(chat_id_hash, session, chat_meta, user_text)
+            # сессию пишем один раз за ход — когда ветка _handle уже выбрала ответ
+            await self._save_session(chat_id_hash, session)
+            return reply
+        finally:
+            _turn_iso.reset(token)
 
+    async def _handle(self, chat_id_hash: str, session: Dict[str, Any], chat_meta: Dict[str, Any], user_text: str) -> BotReply:
         session["chatId"] = str(chat_meta.get("chatId") or session.get("chatId") or "")
         session["channelId"] = str(chat_meta.get("channelId") or session.get("channelId") or "")
         session["chatType"] = str(chat_meta.get("chatType") or session.get("chatType") or "")
@@ -660,15 +746,13 @@ class DialogManager:
         if _is_new_case_command(text):
             self._reset_dialog(session)
             session["mode"] = "new_case"
-            await self._save_session(chat_id_hash, session)
             return BotReply(text="Ок. Начнём заново. Опишите одним сообщением, что случилось (опоздание / забытая вещь / жалоба / благодарность).")
 
         # стоп/отмена
-        if tnorm in {"стоп", "хватит", "отмена", "прекрати", "прекратите"}:
+        if tnorm in _STOP_WORDS:
             self._close_all_cases(session, reason="user_cancel")
             self._reset_dialog(session)
             session["mode"] = "new_case"
-            await self._save_session(chat_id_hash, session)
             return BotReply(text="Ок, остановил. Начнём заново — напишите, что случилось.")
 
         session, is_angry, is_flood = detect_aggression_and_flood(session, text)
@@ -678,12 +762,10 @@ class DialogManager:
             self._close_all_cases(session, reason="user_cancel")
             self._reset_dialog(session)
             session["mode"] = "new_case"
-            await self._save_session(chat_id_hash, session)
             return BotReply(text="Ок, остановил. Начнём заново — напишите, что случилось.")
 
         # greeting при open заявке только если не new_case
         if getattr(nlu_res, "greeting_only", False) and open_case_id and session.get("mode") != "new_case":
-            await self._save_session(chat_id_hash, session)
             return BotReply(
                 text=(
                     f"Здравствуйте! У вас уже есть открытая заявка {open_case_id}.\n"
@@ -704,11 +786,9 @@ class DialogManager:
             and not self._has_collecting_cases(session)
         ):
             if _is_no_more_details(text):
-                await self._save_session(chat_id_hash, session)
                 return BotReply(text="Ок, понял. Спасибо! Если вспомните детали — напишите.")
 
             if _is_followup_noise(text):
-                await self._save_session(chat_id_hash, session)
                 return BotReply(
                     text=(
                         f"У вас есть открытая заявка {open_case_id}.\n"
@@ -717,14 +797,12 @@ class DialogManager:
                 )
 
             ok = await self._append_followup(open_case_id, chat_meta, text)
-            await self._save_session(chat_id_hash, session)
             if ok:
                 return BotReply(text=f"Добавил(а) дополнение к заявке {open_case_id}. Спасибо!")
             return BotReply(text=f"Принял(а) дополнение по заявке {open_case_id}. Спасибо!")
 
         # обычное приветствие
         if getattr(nlu_res, "greeting_only", False) and (not session.get("cases")):
-            await self._save_session(chat_id_hash, session)
             return BotReply(text="Здравствуйте! Опишите проблему одним сообщением (опоздание / забытая вещь / жалоба / благодарность).")
 
         intents: List[str] = list(getattr(nlu_res, "intents", []) or [])
@@ -807,12 +885,10 @@ class DialogManager:
                 if not lcase["slots"].get("when"):
                     lcase["slots"]["when"] = _extract_when(text)
 
-        # primary case
-        primary: Optional[str] = None
-        for ct in ["lost", "complaint", "gratitude"]:
-            if any(c["type"] == ct and c["status"] in ("open", "collecting") for c in session["cases"]):
-                primary = ct
-                break
+        # primary case: активные кейсы по типу — один проход по cases на ход,
+        # индекс нужен ещё и циклу сбора/отправки ниже
+        by_type = _build_case_index(session)
+        primary: Optional[str] = next((ct for ct in _CASE_PRIORITY if ct in by_type), None)
 
         # ask train/car (для delay не спрашиваем car)
         if primary:
@@ -837,20 +913,15 @@ class DialogManager:
 
                 if cnt >= 3:
                     session["pending"] = None
-                    await self._save_session(chat_id_hash, session)
                     return BotReply(text=self._ops_template(primary))
 
-                await self._save_session(chat_id_hash, session)
                 return BotReply(text=self._train_car_question_for(primary, missing_train, missing_car))
 
             self._loop_reset(session)
 
         # collect missing + submit
-        for ct in ["lost", "complaint", "gratitude"]:
-            for case in session["cases"]:
-                if case["type"] != ct or case["status"] not in ("open", "collecting"):
-                    continue
-
+        for ct in _CASE_PRIORITY:
+            for case in by_type.get(ct, ()):
                 # ✅ submit when ready (case status is collecting)
                 if self._is_case_ready(session, case) and case["status"] != "open":
                     case_id = await self._submit_case(chat_id_hash, session, case)
@@ -859,7 +930,6 @@ class DialogManager:
                     ops_text = _fmt_ops_text(case_id, ct, session, chat_meta, case)
 
                     session["mode"] = "normal"
-                    await self._save_session(chat_id_hash, session)
 
                     return BotReply(
                         text=f"Принял(а) ваше обращение: «{_case_title(ct)}». Номер заявки: {case_id}.",
@@ -886,10 +956,8 @@ class DialogManager:
 
                         if cnt >= 3:
                             session["pending"] = None
-                            await self._save_session(chat_id_hash, session)
                             return BotReply(text=self._ops_template("lost"))
 
-                        await self._save_session(chat_id_hash, session)
                         return BotReply(text=self._lost_bundle_question(angry=(is_angry or is_flood)))
 
                 if ct == "complaint":
@@ -904,10 +972,8 @@ class DialogManager:
 
                         if cnt >= 3:
                             session["pending"] = None
-                            await self._save_session(chat_id_hash, session)
                             return BotReply(text=self._ops_template("complaint"))
 
-                        await self._save_session(chat_id_hash, session)
                         return BotReply(text="Уточните, пожалуйста,дату поездки и примерное время (например: вчера 19:00 или 01.02.2026 18:30).")
 
                     if not cs.get("complaintText"):
@@ -919,10 +985,8 @@ class DialogManager:
 
                         if cnt >= 3:
                             session["pending"] = None
-                            await self._save_session(chat_id_hash, session)
                             return BotReply(text=self._ops_template("complaint"))
 
-                        await self._save_session(chat_id_hash, session)
                         return BotReply(text="Понял(а). Что именно случилось? (1–2 предложения, например: опоздал на 1 час / хамство / грязно / не работало отопление).")
 
                 if ct == "gratitude":
@@ -935,11 +999,8 @@ class DialogManager:
 
                         if cnt >= 3:
                             session["pending"] = None
-                            await self._save_session(chat_id_hash, session)
                             return BotReply(text=self._ops_template("gratitude"))
 
-                        await self._save_session(chat_id_hash, session)
                         return BotReply(text="Понял(а). Напишите, пожалуйста, за что благодарите (1–2 предложения).")
 
-        await self._save_session(chat_id_hash, session)
         return BotReply(text="Понял(а). Напишите детали одним сообщением, и я оформлю обращение.")
@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Optional, List
+from typing import Any, Dict, Optional, List, Tuple
 import hashlib
 import logging
 import re
@@ -9,7 +9,7 @@ from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse
 
 from .settings import settings
-from .db import MongoStore
+from .db import MongoStore, utcnow
 from .dialog import DialogManager, BotReply
 from .wazzup_client import WazzupClient
 from .ops_api import router as ops_router
@@ -20,6 +20,8 @@ logging.basicConfig(level=logging.INFO)
 app = FastAPI(title=settings.APP_NAME)
 app.include_router(ops_router)
 
+# один MongoStore / WazzupClient на процесс: создаются при импорте,
+# подключаются в startup и доступны роутерам через app.state
 store = MongoStore()
 dialog = DialogManager(store)
 wazzup = WazzupClient(settings.WAZZUP_API_KEY)
@@ -30,6 +32,9 @@ CASE_ID_RE = re.compile(r"\bKTZH-\d{8}-[0-9A-F]{6}-[0-9A-F]{6}\b", re.I)
 
 @app.on_event("startup")
 async def startup():
+    app.state.store = store
+    app.state.wazzup = wazzup
+
     await store.connect()
     if getattr(store, "enabled", False):
         log.info("Mongo: ENABLED ✅")
@@ -236,6 +241,10 @@ async def _send_to_ops_if_needed(reply: BotReply) -> None:
 
 async def process_items(items: List[Dict[str, Any]]) -> None:
     log.info("WEBHOOK: got %s item(s)", len(items))
+    # одно время приёма на весь webhook — у всех входящих одинаковый createdAt
+    received_at = utcnow()
+
+    inbound: List[Tuple[Dict[str, Any], str]] = []
 
     for item in items:
         msg = extract_inbound(item)
@@ -268,10 +277,12 @@ async def process_items(items: List[Dict[str, Any]]) -> None:
 
         chat_id_hash = chat_hash(msg["chatId"])
         log.info("IN: chatId=%s text=%r", msg["chatId"], msg["text"])
+        inbound.append((msg, chat_id_hash))
 
-        # входящее в mongo
-        if hasattr(store, "add_message"):
-            await store.add_message({
+    # входящие в mongo — одной пачкой на весь webhook
+    if inbound and hasattr(store, "add_messages"):
+        await store.add_messages([
+            {
                 "dir": "in",
                 "chatIdHash": chat_id_hash,
                 "chatId": msg["chatId"],
@@ -279,8 +290,11 @@ async def process_items(items: List[Dict[str, Any]]) -> None:
                 "chatType": msg["chatType"],
                 "text": msg["text"],
                 "raw": msg["raw"],
-            })
+            }
+            for msg, chat_id_hash in inbound
+        ], now=received_at)
 
+    for msg, chat_id_hash in inbound:
         try:
             bot_reply = await dialog.handle(
                 chat_id_hash=chat_id_hash,
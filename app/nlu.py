@@ -2,16 +2,40 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 from typing import Any, Dict, List, Optional, Tuple
+import functools
 import re
 import time
 
 
+# один и тот же текст нормализуют почти все helpers dialog/nlu — считаем один раз
+@functools.lru_cache(maxsize=512)
 def normalize(text: str) -> str:
     t = (text or "").strip().lower()
     t = t.replace("ё", "е")
     return t
 
 
+def _trie_pattern(node: Dict[str, Any]) -> str:
+    # "" в узле — здесь кончается ключ: для проверки «есть ли подстрока»
+    # продолжения уже не нужны (ключ «новая» покрывает «новая заявка»)
+    if "" in node:
+        return ""
+    alts = [re.escape(ch) + _trie_pattern(sub) for ch, sub in sorted(node.items())]
+    return alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+
+
+def keyword_re(keys: Tuple[str, ...]) -> "re.Pattern[str]":
+    # набор подстрок -> trie-регэксп (общие префиксы склеены): на каждой позиции
+    # текста движок идёт по одной ветке, а не перебирает все ключи
+    trie: Dict[str, Any] = {}
+    for k in keys:
+        node = trie
+        for ch in k:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+    return re.compile(_trie_pattern(trie))
+
+
 def extract_train_and_car(text: str) -> Tuple[Optional[str], Optional[int]]:
     """
     Ловим поезд в форматах:
@@ -125,24 +149,30 @@ class SimpleNLU:
         "холодно", "печка", "отоплен","не вежлив","не смывает","мусор","нет бумаги","кондиционер не работает","проблемы с","нет салфеток","отсуствует","отсуствие салфеток" # ✅ чтобы "Холодно" тоже шло как complaint, если надо
     )
     COMPLAINT_HINTS = ("опаз", "задерж", "час", "мин", "беспредел", "ужас", "кошмар", "невыносимо")
+    CANCEL_WORDS = ("стоп", "отмена", "прекрати", "хватит", "закрой", "не надо")
+
+    # каждый набор ключей — один trie-регэксп: один проход по тексту в C на группу
+    _GRATITUDE_RE = keyword_re(GRATITUDE_KEYS)
+    _LOST_RE = keyword_re(LOST_KEYS)
+    _COMPLAINT_RE = keyword_re(COMPLAINT_KEYS + COMPLAINT_HINTS)
+    _CANCEL_RE = keyword_re(CANCEL_WORDS)
 
     def analyze(self, text: str) -> NluResult:
         orig = (text or "").strip()
         t = normalize(orig)
 
-        cancel_words = ("стоп", "отмена", "прекрати", "хватит", "закрой", "не надо")
-        cancel = any(w in t for w in cancel_words)
+        cancel = self._CANCEL_RE.search(t) is not None
 
         greeting_only = bool(
             re.fullmatch(r"(привет|здравствуйте|здрасьте|салам|добрый\s*(день|вечер|утро))[\s!.,…]*", t)
         )
 
         intents: List[str] = []
-        if any(k in t for k in self.GRATITUDE_KEYS):
+        if self._GRATITUDE_RE.search(t):
             intents.append("gratitude")
-        if any(k in t for k in self.LOST_KEYS):
+        if self._LOST_RE.search(t):
             intents.append("lost")
-        if any(k in t for k in self.COMPLAINT_KEYS) or any(h in t for h in self.COMPLAINT_HINTS):
+        if self._COMPLAINT_RE.search(t):
             intents.append("complaint")
 
         train, car = extract_train_and_car(orig)
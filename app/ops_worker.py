@@ -3,11 +3,11 @@ from __future__ import annotations
 import argparse
 import asyncio
 import logging
-from typing import Any, Dict
+from typing import Any, Dict, Tuple
 
 import httpx
 
-from .db import MongoStore
+from .db import MongoStore, utcnow
 from .settings import settings
 
 log = logging.getLogger("ktzh")
@@ -50,59 +50,97 @@ async def _send_http(payload: Dict[str, Any]) -> Dict[str, Any]:
             return {"status_code": r.status_code, "text": r.text[:500]}
 
 
+async def _process_item(item: Dict[str, Any]) -> Tuple[Any, bool, Any, int]:
+    """
+    Отправить одну запись outbox. Статус не пишет — возвращает
+    (outbox_id, ok, resp | error, attempts) для store.mark_outbox_results.
+    """
+    outbox_id = item["_id"]
+    attempts = int(item.get("attempts", 0))
+
+    target = _fill_target_from_env(item)
+    if not target.get("channelId") or not target.get("chatId"):
+        err = "OPS target not configured (channelId/chatId empty)"
+        log.warning("%s; outbox_id=%s", err, outbox_id)
+        return outbox_id, False, err, attempts + 1
+
+    payload = {
+        "channelId": target["channelId"],
+        "chatId": target["chatId"],
+        "chatType": target.get("chatType", "whatsapp"),
+        "text": item.get("text", ""),
+        "meta": {
+            "kind": item.get("kind"),
+            "caseId": item.get("caseId"),
+            "caseType": item.get("caseType"),
+            "source": item.get("source", {}),
+        },
+    }
+
+    try:
+        resp = await _send_http(payload)
+        log.info("OPS sent outbox_id=%s caseId=%s", outbox_id, item.get("caseId"))
+        return outbox_id, True, resp, attempts
+    except Exception as e:
+        err = str(e)
+        log.warning("OPS send failed outbox_id=%s caseId=%s err=%s", outbox_id, item.get("caseId"), err)
+        return outbox_id, False, err, attempts + 1
+
+
 async def run_worker(once: bool = False) -> None:
     store = MongoStore()
-    await store.connect()
+    # legacy-записи outbox (строковые даты, lockUntil null) приводим здесь: claim их иначе не видит
+    await store.connect(migrate_outbox=True)
     if not store.enabled:
         log.warning("MongoStore disabled (no MONGODB_URI). Worker exits.")
         return
 
     log.info("OPS worker started. once=%s", once)
 
+    # --once (cron): одна попытка — одна запись
+    batch = 1 if once else max(1, int(settings.OPS_CLAIM_BATCH or 1))
+
+    # change stream будит сразу на новую pending-запись; пока он жив, таймер
+    # длинный, но не дольше срока ближайшего отложенного ретрая (nextAttemptAt)
+    wake = asyncio.Event()
+    watcher = None
+    if settings.OPS_WATCH and not once:
+        watcher = asyncio.create_task(store.watch_outbox(wake))
+
     try:
         while True:
-            item = await store.claim_pending_outbox()
-            if not item:
+            items = await store.claim_pending_outbox_batch(batch)
+            if not items:
                 if once:
                     return
-                await asyncio.sleep(float(settings.OPS_POLL_SECONDS))
-                continue
-
-            outbox_id = item["_id"]
-            attempts = int(item.get("attempts", 0))
-
-            target = _fill_target_from_env(item)
-            if not target.get("channelId") or not target.get("chatId"):
-                err = "OPS target not configured (channelId/chatId empty)"
-                log.warning("%s; outbox_id=%s", err, outbox_id)
-                await store.mark_outbox_failed(outbox_id, err, attempts + 1)
+                watching = watcher is not None and not watcher.done()
+                idle = float(settings.OPS_IDLE_POLL_SECONDS if watching else settings.OPS_POLL_SECONDS)
+                if watching:
+                    # ретрай по backoff стрим не разбудит в срок — спим не дольше, чем до него
+                    due = await store.next_outbox_attempt_at()
+                    if due is not None:
+                        left = (due - utcnow()).total_seconds()
+                        idle = min(idle, max(float(settings.OPS_POLL_SECONDS), left))
+                try:
+                    await asyncio.wait_for(wake.wait(), timeout=idle)
+                except asyncio.TimeoutError:
+                    pass
+                wake.clear()
                 continue
 
-            payload = {
-                "channelId": target["channelId"],
-                "chatId": target["chatId"],
-                "chatType": target.get("chatType", "whatsapp"),
-                "text": item.get("text", ""),
-                "meta": {
-                    "kind": item.get("kind"),
-                    "caseId": item.get("caseId"),
-                    "caseType": item.get("caseType"),
-                    "source": item.get("source", {}),
-                },
-            }
-
-            try:
-                resp = await _send_http(payload)
-                await store.mark_outbox_sent(outbox_id, resp=resp)
-                log.info("OPS sent outbox_id=%s caseId=%s", outbox_id, item.get("caseId"))
-            except Exception as e:
-                err = str(e)
-                log.warning("OPS send failed outbox_id=%s caseId=%s err=%s", outbox_id, item.get("caseId"), err)
-                await store.mark_outbox_failed(outbox_id, err, attempts + 1)
+            # пачку отправляем параллельно, итоги пишем одним bulk_write
+            results = await asyncio.gather(*(_process_item(item) for item in items))
+            await store.mark_outbox_results(list(results))
 
             if once:
                 return
     finally:
+        if watcher is not None:
+            watcher.cancel()
+            try:
+                await watcher
+            except asyncio.CancelledError:
+                pass
         await store.close()
 
 
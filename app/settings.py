@@ -36,8 +36,41 @@ class Settings:
     COL_SESSIONS: str = env_str("MONGO_SESSIONS_COLLECTION", "sessions")
     COL_MESSAGES: str = env_str("MONGO_MESSAGES_COLLECTION", "messages")
     COL_CASES: str = env_str("MONGO_CASES_COLLECTION", "cases")
+    COL_CASE_FOLLOWUPS: str = env_str("MONGO_CASE_FOLLOWUPS_COLLECTION", "case_followups")
+    # followups кейса лежат пачками по столько заметок в документе
+    FOLLOWUP_BUCKET: int = env_int("FOLLOWUP_BUCKET", 100)
     COL_OPS_OUTBOX: str = env_str("MONGO_OPS_OUTBOX_COLLECTION", "ops_outbox")  # если вдруг оставишь
 
+    # при старте сносить устаревшие индексы (разовая миграция; по умолчанию выкл.)
+    RUN_MIGRATIONS: bool = env_bool("RUN_MIGRATIONS", False)
+
+    # пул соединений Mongo
+    MONGO_POOL: int = env_int("MONGO_POOL", 50)
+    MONGO_MIN_POOL: int = env_int("MONGO_MIN_POOL", 5)
+    MONGO_MAX_CONNECTING: int = env_int("MONGO_MAX_CONNECTING", 10)
+    # zstd/snappy можно добавить, если установлены zstandard/python-snappy
+    MONGO_COMPRESSORS: str = env_str("MONGO_COMPRESSORS", "zlib")
+    MONGO_W: str = env_str("MONGO_W", "majority")
+    MONGO_SERVER_SELECTION_MS: int = env_int("MONGO_SERVER_SELECTION_MS", 3000)
+
+    # кэш сессий в памяти процесса (LRU + TTL), чтобы не читать Mongo на каждое сообщение
+    SESSION_CACHE_TTL_MS: int = env_int("SESSION_CACHE_TTL_MS", 2000)
+    SESSION_CACHE_MAX: int = env_int("SESSION_CACHE_MAX", 10000)
+    # не ждать записи сессии в Mongo (write-behind через общий буфер записей);
+    # при падении процесса теряются последние ~MONGO_WRITE_FLUSH_MS изменений
+    SESSION_WRITE_BEHIND: bool = env_bool("SESSION_WRITE_BEHIND", False)
+    # потолок отложенных записей сессий; выше него save_session снова ждёт Mongo
+    SESSION_WRITE_BEHIND_MAX: int = env_int("SESSION_WRITE_BEHIND_MAX", 1000)
+
+    # записи (messages/sessions/cases) копим и пишем пачками через bulk_write
+    WRITE_BATCH: int = env_int("MONGO_WRITE_BATCH", 200)
+    WRITE_FLUSH_MS: int = env_int("MONGO_WRITE_FLUSH_MS", 100)
+    # потолок буфера записей: дальше ждущие записи ждут места, лог сообщений отбрасывается
+    WRITE_QUEUE_MAX: int = env_int("MONGO_WRITE_QUEUE_MAX", 10000)
+    # write concern лога сообщений: 1 = ack от primary без журнала (j=False),
+    # 0 = fire-and-forget (ошибки вставки не видны)
+    MESSAGES_W: int = env_int("MONGO_MESSAGES_W", 1)
+
     # Wazzup
     WAZZUP_API_URL: str = env_str("WAZZUP_API_URL", "https://api.wazzup24.com/v3")
     WAZZUP_API_KEY: str = env_str("WAZZUP_API_KEY", "")
@@ -59,6 +92,20 @@ class Settings:
     OPS_CHAT_ID: str = env_str("OPS_CHAT_ID", "")
     OPS_CHAT_TYPE: str = env_str("OPS_CHAT_TYPE", "whatsapp")
 
+    # ops_worker: куда слать outbox, как часто опрашивать и сколько брать за раз
+    OPS_SEND_URL: str = env_str("OPS_SEND_URL", "")
+    OPS_POLL_SECONDS: int = env_int("OPS_POLL_SECONDS", 2)
+    OPS_CLAIM_BATCH: int = env_int("OPS_CLAIM_BATCH", 10)
+    OPS_CLAIM_MAX_TIME_MS: int = env_int("OPS_CLAIM_MAX_TIME_MS", 500)
+    # будить воркер change stream-ом (нужен replica set); тогда таймер — только страховка
+    OPS_WATCH: bool = env_bool("OPS_WATCH", True)
+    OPS_IDLE_POLL_SECONDS: int = env_int("OPS_IDLE_POLL_SECONDS", 30)
+    # несколько воркеров: у каждого свой OPS_WORKER_ID из 0..OPS_WORKER_COUNT-1
+    OPS_WORKER_ID: int = env_int("OPS_WORKER_ID", 0)
+    OPS_WORKER_COUNT: int = env_int("OPS_WORKER_COUNT", 1)
+    # через сколько секунд после отправки запись outbox удаляется (TTL-индекс)
+    OPS_OUTBOX_SENT_TTL_SECONDS: int = env_int("OPS_OUTBOX_SENT_TTL_SECONDS", 86400)
+
     # ops_api (если хочешь оставлять ручной endpoint /api/v1/ops/send)
     OPS_SEND_TOKEN: str = env_str("OPS_SEND_TOKEN", "")
 